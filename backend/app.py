@@ -1,17 +1,48 @@
 
 import os
+import re
 import json
+import queue
+import threading
+import time
+import uuid
+import base64
 import datetime
-import requests
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import Flask, Response, request, jsonify, stream_with_context, g
 from flask_cors import CORS
 from dotenv import load_dotenv
+from local_db import LocalDB, MockFirestore, STORAGE_MODE
+from http_client import UpstreamClient, deadline_in
+from caches import TTLCache, MoodCache, ResponseCache, MISS, normalize_title, normalize_mood
+from llm_stream import JsonArrayStream, iter_chat_deltas, sse_event
+from model_router import ModelRouter
+from catalog import open_catalog
+from local_recommender import open_recommender
+from jobs import JobQueue
+import metrics
 
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 
 app = Flask(__name__)
 CORS(app)
 
+# Route latency histograms, plus a Server-Timing breakdown (llm, enrich, db, ...) on every response
+@app.before_request
+def start_request_timer():
+    g.metrics_token = metrics.start_request()
+
+@app.after_request
+def finish_request_timer(response):
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        timer = metrics.finish_request(token, route, request.method, response.status_code)
+        if timer is not None:
+            response.headers['Server-Timing'] = timer.server_timing()
+            response.headers['Timing-Allow-Origin'] = '*' # lets the frontend's origin read it
+    return response
+
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 TMDB_API_KEY = os.getenv("TMDB_API_KEY") 
 OMDB_API_KEY = os.getenv("OMDB_API_KEY")
@@ -21,177 +52,128 @@ if OPENROUTER_API_KEY: OPENROUTER_API_KEY = OPENROUTER_API_KEY.strip().replace('
 if OMDB_API_KEY: OMDB_API_KEY = OMDB_API_KEY.strip().replace('"', '').replace("'", "")
 if TMDB_API_KEY: TMDB_API_KEY = TMDB_API_KEY.strip().replace('"', '').replace("'", "")
 
-print(f"DEBUG: Loaded OpenRouter Key: {OPENROUTER_API_KEY[:5]}...{OPENROUTER_API_KEY[-5:] if OPENROUTER_API_KEY else 'None'}")
+print(f"DEBUG: Loaded OpenRouter Key: {OPENROUTER_API_KEY[:5] + '...' + OPENROUTER_API_KEY[-5:] if OPENROUTER_API_KEY else 'None'}")
 
-TMDB_BASE_URL = "https://api.themoviedb.org/3"
+# Upstream URLs can be pointed at local stubs (see stub_upstreams.py)
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+TMDB_BASE_URL = os.getenv("TMDB_BASE_URL", "https://api.themoviedb.org/3")
 TMDB_IMAGE_BASE_URL = "https://image.tmdb.org/t/p/w500"
-OMDB_URL = "http://www.omdbapi.com/"
-
-# --- Local DB Implementation ---
-class LocalDocument:
-    def __init__(self, data, doc_id, wrapper):
-        self._data = data
-        self.id = doc_id
-        self.exists = data is not None
-        self._wrapper = wrapper
-
-    def to_dict(self):
-        return self._data if self._data else {}
-    
-    @property
-    def reference(self):
-        return self
+OMDB_URL = os.getenv("OMDB_URL", "http://www.omdbapi.com/")
 
-    def get(self):
-        return self
+# All outbound calls go through pooled, time-bounded clients (one per upstream host)
+openrouter_client = UpstreamClient('openrouter', read_timeout=float(os.getenv("OPENROUTER_READ_TIMEOUT", 30)), retries=1, budget=45)
+tmdb_client = UpstreamClient('tmdb', read_timeout=float(os.getenv("TMDB_READ_TIMEOUT", 5)), retries=2, budget=8)
+omdb_client = UpstreamClient('omdb', read_timeout=float(os.getenv("OMDB_READ_TIMEOUT", 5)), retries=2, budget=8)
+# Shared TMDB/OMDb title lookups; not-found results are cached for a shorter time
+movie_cache = TTLCache(
+    'movie_metadata',
+    ttl=int(os.getenv("MOVIE_CACHE_TTL", 24 * 3600)),
+    negative_ttl=int(os.getenv("MOVIE_CACHE_NEGATIVE_TTL", 3600)),
+    max_entries=int(os.getenv("MOVIE_CACHE_MAX_ENTRIES", 5000)),
+    max_bytes=int(os.getenv("MOVIE_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+)
+# Enriched AI recommendations keyed on the normalised mood ("Sad!" == "feeling sad").
+# RECOMMEND_CACHE_SIMILARITY > 0 (e.g. 0.85) also serves near-identical moods (bigram
+# cosine, see MoodCache); off by default.
+recommendation_cache = MoodCache(
+    'recommendations',
+    ttl=int(os.getenv("RECOMMEND_CACHE_TTL", 1800)),
+    max_entries=int(os.getenv("RECOMMEND_CACHE_MAX_ENTRIES", 500)),
+    similarity=float(os.getenv("RECOMMEND_CACHE_SIMILARITY", 0)),
+)
+# Serialised GET /api/posts and /api/history bodies, valid until the collections they read change
+response_cache = ResponseCache('responses', max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000)))
+# Offline title catalog (see catalog.py), tried before TMDB/OMDb; optional
+catalog = open_catalog(os.getenv("MOVIE_CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.bin')))
+# Offline LSI recommender over the catalog (see local_recommender.py; needs numpy and a built model).
+# LOCAL_RECOMMENDER=fallback uses it when the LLM comes back empty, "first" answers from it
+# before asking the LLM at all, "off" disables it.
+local_recommender = open_recommender(catalog)
+LOCAL_RECOMMENDER = os.getenv("LOCAL_RECOMMENDER", "fallback")
+# Overall time allowed for one /api/recommend request across every upstream call
+RECOMMEND_BUDGET = float(os.getenv("RECOMMEND_BUDGET", 60))
 
-    def set(self, data):
-        self._wrapper.set_doc(self.id, data)
+# Metadata lookups for the LLM's picks run concurrently on a bounded pool
+ENRICH_WORKERS = int(os.getenv("ENRICH_WORKERS", 8))
+ENRICH_TIMEOUT = float(os.getenv("ENRICH_TIMEOUT", 10))
+enrich_pool = ThreadPoolExecutor(max_workers=ENRICH_WORKERS, thread_name_prefix='enrich')
 
-    def update(self, data):
-        if not self.exists: return
-        current = self._data.copy()
-        
-        # Handle simple updates and ArrayUnion
-        for k, v in data.items():
-            if isinstance(v, list) and hasattr(v, 'is_array_union'):
-                if k not in current: current[k] = []
-                current[k].extend(v)
-            else:
-                current[k] = v
-        self._wrapper.set_doc(self.id, current)
-
-    def delete(self):
-        self._wrapper.delete_doc(self.id)
-
-class LocalCollection:
-    def __init__(self, name):
-        self.name = name
-        self.file_path = os.path.join(os.path.dirname(__file__), f'{name}.json')
-        self._load()
-
-    def _load(self):
-        if not os.path.exists(self.file_path):
-            if self.name in ['posts', 'search_history']: self.data = []  # Lists
-            else: self.data = {} # Users as dict
-            self._save()
-        else:
-            with open(self.file_path, 'r') as f:
-                try:
-                    self.data = json.load(f)
-                except:
-                    self.data = [] if self.name in ['posts', 'search_history'] else {}
-
-    def _save(self):
-        with open(self.file_path, 'w') as f:
-            json.dump(self.data, f, indent=4, default=str)
-
-    def document(self, doc_id):
-        if isinstance(self.data, dict):
-            # Dict based collection (users)
-            return LocalDocument(self.data.get(doc_id), doc_id, self)
-        else:
-            # List based collection (posts, history)
-            # Find item by 'id' field
-            item = next((x for x in self.data if str(x.get('id', '')) == str(doc_id)), None)
-            return LocalDocument(item, doc_id, self)
-
-    def set_doc(self, doc_id, data):
-        if isinstance(self.data, dict):
-            self.data[doc_id] = data
-        else:
-            # Create new or replace
-            existing = next((i for i, x in enumerate(self.data) if str(x.get('id', '')) == str(doc_id)), None)
-            data['id'] = doc_id
-            if existing is not None:
-                self.data[existing] = data
-            else:
-                self.data.append(data)
-        self._save()
+firestore = MockFirestore()
+if STORAGE_MODE == 'sqlite':
+    from sqlite_db import SqliteDB
+    db = SqliteDB()
+    print(f"DEBUG: Using SQLite Database ({db.path})")
+else:
+    db = LocalDB() 
+    print("DEBUG: Using Local JSON Database")
 
-    def delete_doc(self, doc_id):
-        if isinstance(self.data, dict):
-            if doc_id in self.data:
-                del self.data[doc_id]
-        else:
-            self.data = [x for x in self.data if str(x.get('id', '')) != str(doc_id)]
-        self._save()
-
-    def add(self, data):
-        import uuid
-        doc_id = str(uuid.uuid4())
-        data['id'] = doc_id
-        if isinstance(self.data, list):
-            self.data.append(data)
-            self._save()
-            return datetime.datetime.now(), self.document(doc_id)
-        return None, None
-
-    # Query methods
-    def where(self, field, op, value):
-        # Return a filtered View of collection
-        return QueryView(self.data, self.name).where(field, op, value)
-
-    def order_by(self, field, direction='desc'):
-        return QueryView(self.data, self.name).order_by(field, direction)
-        
-    def stream(self):
-        return QueryView(self.data, self.name).stream()
+# search_history keeps at most HISTORY_PER_USER entries per user and, if a deployment
+# sets HISTORY_RETENTION_DAYS, drops entries older than that (off by default: expiring
+# existing history is the operator's call). Entries dropped either way are counted into
+# the user's mood totals in history_rollups first. With retention on, each worker sweeps
+# for expired entries every HISTORY_PURGE_INTERVAL seconds.
+HISTORY_PER_USER = int(os.getenv("HISTORY_PER_USER", 50))
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", 0))
+HISTORY_PURGE_INTERVAL = float(os.getenv("HISTORY_PURGE_INTERVAL", 3600))
+ROLLUP_MAX_MOODS = 100 # distinct moods kept per user, least frequent dropped first
 
-class QueryView:
-    def __init__(self, data, name):
-        self.data = data # List or Dict
-        self.name = name # collection name
-        
-    def where(self, field, op, value):
-        # Only support == for now as per app usage
-        if isinstance(self.data, dict):
-            filtered = {k:v for k,v in self.data.items() if v.get(field) == value}
-            return QueryView(filtered, self.name)
-        else:
-            filtered = [x for x in self.data if x.get(field) == value]
-            return QueryView(filtered, self.name)
-
-    def order_by(self, field, direction='desc'):
-        # Only lists can be ordered
-        if isinstance(self.data, list):
-            reverse = True # Default desc
-            sorted_data = sorted(self.data, key=lambda x: x.get(field, ''), reverse=reverse)
-            return QueryView(sorted_data, self.name)
-        return self
-
-    def limit(self, limit):
-        if isinstance(self.data, list):
-            return QueryView(self.data[:limit], self.name)
-        return self
-
-    def stream(self):
-        # Yield LocalDocuments
-        if isinstance(self.data, dict):
-            for k, v in self.data.items():
-                yield LocalDocument(v, k, None) # Wrapper None for read-only stream mostly
-        else:
-            for item in self.data:
-                yield LocalDocument(item, item.get('id'), LocalCollection(self.name))
-
-class LocalDB:
-    def collection(self, name):
-        return LocalCollection(name)
-
-# Mock Firestore helpers
-class MockFirestore:
-    def client(self): return LocalDB()
-    class Query:
-        DESCENDING = 'desc'
-    class ArrayUnion(list):
-        def __init__(self, iterable):
-            super().__init__(iterable)
-            self.is_array_union = True
-    SERVER_TIMESTAMP = datetime.datetime.now().isoformat()
+# Comments live in their own collection (indexed by post_id); posts keep a
+# commentCount and only the latest few inline for the feed.
+COMMENT_PREVIEW = 3
 
-firestore = MockFirestore()
-db = LocalDB() 
-print("DEBUG: Using Local JSON Database")
+def migrate_embedded_comments():
+    # One-off move of comments embedded in older posts into the comments collection.
+    # Runs under the posts lock, so concurrently starting workers migrate each post once.
+    posts = db.collection('posts')
+    if all('commentCount' in doc.peek() for doc in posts.stream()):
+        return
+    comments = db.collection('comments')
+    moved = 0
+    with db.transaction() as txn:
+        txn.lock(comments, posts)
+        for doc in posts.stream():
+            current = txn.get(doc)
+            p = current.to_dict()
+            if 'commentCount' in p:
+                continue
+            preview = []
+            for c in p.get('comments', []):
+                comment_id = str(uuid.uuid4())
+                comment = {**c, 'id': comment_id, 'post_id': doc.id}
+                txn.set(comments.document(comment_id), comment)
+                preview.append(dict(comment))
+            txn.update(current, {'commentCount': len(preview), 'comments': preview[-COMMENT_PREVIEW:]})
+            moved += 1
+    print(f"DEBUG: Moved embedded comments of {moved} posts into the comments collection")
+
+_started_pid = None
+
+def startup():
+    """Once per serving process, before it takes requests: data migrations and
+    background workers. Called by the entry points (python app.py, gunicorn.conf.py,
+    the ASGI lifespan) instead of at import, so scripts that import app don't
+    rewrite the data files."""
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+    migrate_embedded_comments()
+    # Job workers, picking up any persisted jobs a dead worker process left behind
+    # (submit() also starts them on first use), then a sweep for history from before
+    # the per-user cap (and past the retention cutoff, if one is configured)
+    job_queue.start()
+    job_queue.submit('purge_history', {'compact': True})
+
+# History writes and post enrichment run on background workers, after the response.
+# JOB_QUEUE_PERSIST=1 also keeps queued jobs in the 'jobs' collection so they survive a
+# restart; JOB_QUEUE=inline runs them in the request thread instead (tests, debugging).
+job_queue = JobQueue(
+    workers=int(os.getenv("JOB_WORKERS", 2)),
+    store=db.collection('jobs') if os.getenv("JOB_QUEUE_PERSIST", "0") == "1" else None,
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", 3)),
+    inline=os.getenv("JOB_QUEUE") == "inline",
+)
+metrics.Collected('movieguru_jobs_pending', 'Background jobs queued or running', 'gauge', [], lambda: [((), job_queue.pending())])
 
 
 # --- Helper Functions ---
@@ -201,6 +183,95 @@ def get_user_ref(email):
 def get_post_ref(post_id):
     return db.collection('posts').document(post_id)
 
+MAX_PAGE_SIZE = 100
+
+def encode_cursor(doc, field='timestamp'):
+    # Opaque page token: the (order value, id) of the last document served
+    raw = json.dumps([doc.peek().get(field, ''), doc.id], default=str)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        value, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return value, doc_id
+    except Exception:
+        return None
+
+def paginate(query, default_size):
+    """Apply ?page_size= / ?cursor= to an ordered query.
+
+    Returns (docs, next_cursor, paginated); raises ValueError on a bad cursor.
+    paginated is False for legacy callers that sent neither parameter.
+    """
+    page_size = request.args.get('page_size', type=int)
+    cursor = request.args.get('cursor')
+    paginated = page_size is not None or cursor is not None
+    page_size = max(1, min(page_size or default_size, MAX_PAGE_SIZE))
+
+    if cursor:
+        after = decode_cursor(cursor)
+        if after is None:
+            raise ValueError('Invalid cursor')
+        query = query.start_after(after)
+
+    # Fetch one extra row to know whether another page exists
+    docs = list(query.limit(page_size + 1).stream())
+    next_cursor = encode_cursor(docs[page_size - 1]) if len(docs) > page_size else None
+    return docs[:page_size], next_cursor, paginated
+
+def cached_json(key, version, build, cache_control='no-cache'):
+    """JSON response for build(), served from response_cache while `version` holds.
+
+    Sends an ETag and answers a matching If-None-Match with 304, so polling
+    clients revalidate (Cache-Control: no-cache) without re-downloading.
+    """
+    entry = response_cache.get(key, version)
+    if entry is None:
+        entry = response_cache.set(key, version, app.json.response(build()).get_data())
+    body, etag = entry
+    response = Response(body, mimetype=app.json.mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+def set_profile_icon(user_ref, icon):
+    # Cached feed pages depend on icons, not on the rest of users (favorites, passwords),
+    # so icon changes bump their own counter for the feed to key on
+    user_ref.update({'profileIcon': icon})
+    db.collection('counters').document('profile_icons').set({'updated': firestore.SERVER_TIMESTAMP})
+
+def with_profile_icons(posts):
+    """Posts (or comments) with profileIcons resolved from the authors' user records.
+
+    Icons are resolved at read time so a profile icon change never rewrites
+    posts. Anonymous posts, and authors with no stored icon, keep the icon
+    saved with the post. Records are copied only when an icon changes, so
+    stored records (LocalDocument.peek) can be passed straight in.
+    """
+    users = db.collection('users')
+    icons = {}
+    def icon_of(email, stored):
+        if email not in icons:
+            doc = users.document(email).get() if email else None
+            icons[email] = doc.peek().get('profileIcon') if doc is not None and doc.exists else None
+        return icons[email] or stored
+
+    def resolve(record):
+        out = record
+        if not record.get('anonymous', False):
+            icon = icon_of(record.get('author'), record.get('profileIcon'))
+            if icon != record.get('profileIcon'):
+                out = {**record, 'profileIcon': icon}
+        comments = record.get('comments')
+        if comments:
+            resolved = [resolve(c) for c in comments]
+            if any(r is not c for r, c in zip(resolved, comments)):
+                out = dict(out) if out is record else out
+                out['comments'] = resolved
+        return out
+
+    return [resolve(p) for p in posts]
+
 # --- Routes ---
 
 @app.route('/api/signup', methods=['POST'])
@@ -247,7 +318,7 @@ def login():
     # Ensure profileIcon exists
     if 'profileIcon' not in user_data:
         user_data['profileIcon'] = '👤'
-        user_ref.update({'profileIcon': '👤'})
+        set_profile_icon(user_ref, '👤')
     
     return jsonify({
         'email': email, 
@@ -269,33 +340,10 @@ def update_profile_icon():
     if not user_ref.get().exists:
         return jsonify({'error': 'User not found'}), 404
     
-    # Update user's profile icon
-    user_ref.update({'profileIcon': profile_icon})
-    
-    # Update icons in posts 
-    posts_ref = db.collection('posts')
-    query = posts_ref.where('author', '==', email).stream()
-    for post in query:
-        if not post.to_dict().get('anonymous', False):
-             post.update({'profileIcon': profile_icon})
-             
-    # Update comments
-    all_posts = posts_ref.stream()
-    updated = False
-    for post_doc in all_posts:
-        p_data = post_doc.to_dict()
-        p_comments = p_data.get('comments', [])
-        comments_changed = False
-        for comment in p_comments:
-            if comment.get('author') == email:
-                comment['profileIcon'] = profile_icon
-                comments_changed = True
-        
-        if comments_changed:
-            post_doc.update({'comments': p_comments})
-            updated = True
+    # Posts and comments pick the new icon up at read time (with_profile_icons)
+    set_profile_icon(user_ref, profile_icon)
 
-    return jsonify({'profileIcon': profile_icon, 'postsUpdated': updated})
+    return jsonify({'profileIcon': profile_icon})
 
 def get_mock_movies():
     return [
@@ -304,6 +352,346 @@ def get_mock_movies():
         {"id": 155, "title": "The Dark Knight", "vote_average": 8.5, "poster_path": "/qJ2tW6WMUDux911r6m7haRef0WH.jpg", "release_date": "2008-07-14", "overview": "Batman vs Joker."}
     ]
 
+# Lookups are split into request / response halves so asgi.py can run the
+# same cache logic over an async client.
+def tmdb_lookup_request(title, year=None):
+    key = ('tmdb', normalize_title(title), str(year or ''))
+    params = {'api_key': TMDB_API_KEY, 'query': title}
+    if year: params['year'] = year
+    return key, params
+
+def tmdb_lookup_result(key, tmdb_res):
+    if tmdb_res.status_code != 200:
+        return None # upstream trouble: don't cache
+    results = tmdb_res.json().get('results')
+    m = results[0] if results else None
+    movie_cache.set(key, m)
+    return m
+
+def lookup_tmdb(title, year=None, deadline=None):
+    # First TMDB search hit for a title (None if nothing matched), via movie_cache
+    key, params = tmdb_lookup_request(title, year)
+    cached = movie_cache.get(key)
+    if cached is not MISS:
+        return cached
+    return tmdb_lookup_result(key, tmdb_client.get(f"{TMDB_BASE_URL}/search/movie", params=params, deadline=deadline))
+
+def omdb_lookup_request(title, year=None):
+    key = ('omdb', normalize_title(title), str(year or ''))
+    params = {'apikey': OMDB_API_KEY, 't': title, 'type': 'movie'}
+    if year: params['y'] = year
+    return key, params
+
+def omdb_lookup_result(key, omdb_res):
+    if omdb_res.status_code != 200:
+        return None
+    m = omdb_res.json()
+    if m.get('Response') == 'True':
+        movie_cache.set(key, m)
+        return m
+    if m.get('Error') == 'Movie not found!':
+        # Only a definite miss is cached; key/quota errors are not
+        movie_cache.set(key, None)
+    return None
+
+def lookup_omdb(title, year=None, deadline=None):
+    # OMDb record for a title (None if not found), via movie_cache
+    key, params = omdb_lookup_request(title, year)
+    cached = movie_cache.get(key)
+    if cached is not MISS:
+        return cached
+    return omdb_lookup_result(key, omdb_client.get(OMDB_URL, params=params, deadline=deadline))
+
+def movie_from_tmdb(m, reason):
+    return {'id': m['id'], 'title': m['title'], 'poster_path': m.get('poster_path'), 'overview': m.get('overview'), 'vote_average': m.get('vote_average'), 'ai_reason': reason, 'release_date': m.get('release_date')}
+
+def movie_from_omdb(m, reason):
+    poster = m.get('Poster')
+    if poster == 'N/A': poster = None
+    try:
+        rating = float(m.get('imdbRating', 0))
+    except:
+        rating = 0.0
+    return {
+        'id': m.get('imdbID'),
+        'title': m.get('Title'),
+        'poster_path': poster,
+        'overview': m.get('Plot'),
+        'vote_average': rating, 
+        'ai_reason': reason,
+        'release_date': m.get('Released')
+    }
+
+def lookup_catalog(title, year=None):
+    # Offline catalog record (TMDB search-result shape), or None
+    try:
+        return catalog.search(title, year) if catalog else None
+    except Exception as e:
+        print(f"Catalog lookup failed for {title}: {e}")
+        return None
+
+def enrich_movie(title, reason, use_tmdb, deadline=None, year=None):
+    # Map one AI pick to catalog, TMDB (or OMDb fallback) metadata; None if not found.
+    # A catalog hit without a poster (e.g. from an IMDb dump) is only used if the network has nothing.
+    local = lookup_catalog(title, year)
+    if local and local.get('poster_path'):
+        return movie_from_tmdb(local, reason)
+    try:
+        movie = enrich_movie_online(title, reason, use_tmdb, deadline, year)
+    except Exception:
+        if not local:
+            raise
+        movie = None
+    return movie or (movie_from_tmdb(local, reason) if local else None)
+
+def enrich_movie_online(title, reason, use_tmdb, deadline=None, year=None):
+    if use_tmdb:
+        m = lookup_tmdb(title, year, deadline=deadline)
+        if m:
+            return movie_from_tmdb(m, reason)
+    elif OMDB_API_KEY:
+        # OMDb fallback
+        m = lookup_omdb(title, year, deadline=deadline)
+        if m:
+            return movie_from_omdb(m, reason)
+    return None
+
+def enrich_recommendations(recommendations, use_tmdb, pool=None, deadline=None):
+    """Look up every recommendation concurrently, keeping the LLM's order.
+
+    Titles still pending after ENRICH_TIMEOUT seconds are dropped so one slow
+    lookup can't hold back the rest.
+    """
+    pool = pool or enrich_pool
+    deadline = min(deadline or float('inf'), deadline_in(ENRICH_TIMEOUT))
+    futures = [pool.submit(enrich_movie, rec.get('title'), rec.get('reason'), use_tmdb, deadline, rec.get('year')) for rec in recommendations]
+    done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+    for future in not_done:
+        future.cancel()
+
+    movies = []
+    for rec, future in zip(recommendations, futures):
+        if future not in done:
+            print(f"Metadata lookup timed out for {rec.get('title')}")
+        elif future.exception():
+            print(f"Metadata lookup failed for {rec.get('title')}: {future.exception()}")
+        elif future.result():
+            movies.append(future.result())
+    return movies
+
+MODELS_TO_TRY = ["openrouter/free", "google/gemini-2.0-flash-exp:free", "mistralai/mistral-7b-instruct:free"]
+
+# LLM_STRATEGY=hedge starts the next model once the current one runs past its
+# LLM_HEDGE_PERCENTILE latency; "sequential" only moves on after a failure.
+model_router = ModelRouter(
+    MODELS_TO_TRY,
+    hedge=os.getenv("LLM_STRATEGY", "hedge") == "hedge",
+    hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", 0.9)),
+    default_hedge_delay=float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", 4.0)),
+    failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", 3)),
+    cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN", 60)),
+)
+
+# Cache and model health numbers are read from their stats() at scrape time
+CACHES = (movie_cache, recommendation_cache, response_cache)
+
+def cache_stat(read):
+    return lambda: [((stats['name'],), read(stats)) for stats in (cache.stats() for cache in CACHES)]
+
+metrics.Collected('movieguru_cache_hits_total', 'Cache hits (including similar-mood hits)', 'counter', ['cache'],
+                  cache_stat(lambda stats: stats['hits'] + stats.get('similar_hits', 0)))
+metrics.Collected('movieguru_cache_misses_total', 'Cache misses', 'counter', ['cache'], cache_stat(lambda stats: stats['misses']))
+metrics.Collected('movieguru_cache_hit_ratio', 'Cache hit ratio since start', 'gauge', ['cache'], cache_stat(lambda stats: stats['hit_ratio']))
+metrics.Collected('movieguru_cache_entries', 'Cache entries', 'gauge', ['cache'], cache_stat(lambda stats: stats['entries']))
+metrics.Collected('movieguru_cache_bytes', 'Approximate cache size in bytes', 'gauge', ['cache'], cache_stat(lambda stats: stats['bytes']))
+metrics.Collected('movieguru_llm_error_rate', 'Decaying error rate per model (as used for routing)', 'gauge', ['model'],
+                  lambda: [((model,), stats['error_rate']) for model, stats in model_router.stats().items()])
+metrics.Collected('movieguru_llm_circuit_open', '1 while the model\'s circuit breaker is open', 'gauge', ['model'],
+                  lambda: [((model,), int(stats['circuit_open'])) for model, stats in model_router.stats().items()])
+
+def use_tmdb_enabled():
+    return bool(TMDB_API_KEY and len(TMDB_API_KEY) > 20 and "YOUR_TMDB_API_KEY" not in TMDB_API_KEY)
+
+def mood_explanation(mood):
+    # Built per request: cached picks are shared by every mood that normalises to the same key
+    return f"Here are some picks for your mood: '{mood}'"
+
+def build_recommend_prompt(mood):
+    return f"""
+            Act as a movie expert. The user is feeling: "{mood}".
+            Suggest 5 movies that perfectly match this emotional state or theme.
+            Return ONLY a raw JSON array of objects: [ {{"title": "Title", "reason": "Reason"}} ]
+            """
+
+def openrouter_request(model, prompt, stream=False):
+    # (headers, payload) for one chat completion call
+    headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {OPENROUTER_API_KEY}', 'HTTP-Referer': 'http://localhost:5173', 'X-Title': 'MovieGuru'}
+    payload = {"messages": [{"role": "system", "content": "You are a helpful movie expert."}, {"role": "user", "content": prompt}], "model": model, "temperature": 0.7}
+    if stream: payload['stream'] = True
+    return headers, payload
+
+def openrouter_call(model, prompt, deadline=None, stream=False):
+    headers, payload = openrouter_request(model, prompt, stream)
+    return openrouter_client.post(OPENROUTER_URL, headers=headers, json=payload, deadline=deadline, stream=stream)
+
+def recommendations_from_response(response):
+    # A valid result is a parsed, non-empty list of picks; raises on an HTTP error
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+    return parse_recommendations(response.json()['choices'][0]['message']['content']) or None
+
+def parse_recommendations(content):
+    # Pull the JSON array of {title, reason} out of a model reply; None if there isn't one
+    clean_json = content.replace('```json', '').replace('```', '').strip()
+    match = re.search(r'\[.*\]', clean_json, re.DOTALL)
+    return json.loads(match.group(0)) if match else None
+
+def fallback_search_movies(tmdb_res):
+    movies = []
+    if tmdb_res.status_code == 200:
+        for m in tmdb_res.json().get('results', [])[:5]:
+             movies.append({'id': m['id'], 'title': m['title'], 'poster_path': m.get('poster_path'), 'overview': m.get('overview'), 'vote_average': m.get('vote_average')})
+    return movies
+
+def fallback_result(movies):
+    if movies:
+        return movies, ""
+    return get_mock_movies(), "We couldn't connect services, but try these favorites!"
+
+def local_recommendations(mood, email=None):
+    # (movies, explanation) from the offline recommender, blending in the user's favorites;
+    # ([], "") when it is off or finds nothing
+    if not local_recommender or LOCAL_RECOMMENDER == 'off':
+        return [], ""
+    try:
+        with metrics.timed('local'):
+            user = get_user_ref(email) if email else None
+            favorites = user.peek().get('favorites', []) if user and user.exists else []
+            picks = local_recommender.recommend(mood, favorites)
+    except Exception as e:
+        print(f"Local recommender error: {e}")
+        return [], ""
+    movies = [movie_from_tmdb(record, reason) for record, reason in picks]
+    return movies, (mood_explanation(mood) if movies else "")
+
+def fallback_movies(mood, use_tmdb, deadline=None, email=None):
+    # Offline recommender, then TMDB keyword search on the raw mood, then the hardcoded picks
+    movies, explanation = local_recommendations(mood, email)
+    if movies:
+        return movies, explanation
+    if use_tmdb:
+         try:
+            tmdb_res = tmdb_client.get(f"{TMDB_BASE_URL}/search/movie", params={'api_key': TMDB_API_KEY, 'query': mood}, deadline=deadline)
+            movies = fallback_search_movies(tmdb_res)
+         except: pass
+    return fallback_result(movies)
+
+def save_history(mood, movies, email):
+    # Queued; the id is picked here so a retried job rewrites the same record
+    if db:
+        try:
+            if email:
+                job_queue.submit('history', {'doc_id': str(uuid.uuid4()), 'record': {
+                    'mood': mood,
+                    'result_count': len(movies),
+                    'email': email,
+                    # The time of the search, not of the (possibly retried) job
+                    'timestamp': datetime.datetime.now().isoformat()
+                }})
+            schedule_history_purge()
+        except Exception as e:
+            print(f"History Save Error: {e}")
+
+@job_queue.handler('history')
+def write_history(doc_id, record):
+    trim_history(record['email'], doc_id, record)
+
+def history_cutoff():
+    # Entries with an older timestamp have expired; None when retention is off
+    if HISTORY_RETENTION_DAYS <= 0:
+        return None
+    return (datetime.datetime.now() - datetime.timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+
+def trim_history(email, doc_id=None, record=None):
+    """Add record (if given) to email's history, then roll up and delete whatever is
+    past the per-user cap or the retention cutoff. Returns the number of entries dropped."""
+    history = db.collection('search_history')
+    rollups = db.collection('history_rollups')
+    cutoff = history_cutoff()
+    with db.transaction() as txn:
+        txn.lock(rollups, history)
+        rollup_ref = rollups.document(email or '')
+        rollup = txn.get(rollup_ref).to_dict()
+
+        entries = [doc.peek() for doc in history.where('email', '==', email).stream()
+                   if doc.id != doc_id] # already written by an earlier run of the same job
+        if record is not None:
+            entries.append(record)
+        # Newest first; jobs can finish out of order, so the new record isn't always the newest
+        entries.sort(key=lambda e: (str(e.get('timestamp', '')), e.get('id', doc_id)), reverse=True)
+        dropped = entries[HISTORY_PER_USER:]
+        if cutoff:
+            dropped += [e for e in entries[:HISTORY_PER_USER] if str(e.get('timestamp', '')) < cutoff]
+
+        stored = [e for e in dropped if e is not record]
+        if record is not None and len(stored) == len(dropped):
+            # The new entry takes the oldest dropped one's slot instead of growing the collection
+            replace = history.document(stored.pop()['id']) if stored else None
+            txn.set(history.document(doc_id), record, replace=replace)
+        for e in stored:
+            txn.delete(history.document(e['id']))
+        if dropped and email:
+            moods = dict(rollup.get('moods', {}))
+            for e in dropped:
+                key = normalize_mood(e.get('mood'))
+                if key:
+                    moods[key] = moods.get(key, 0) + 1
+            if len(moods) > ROLLUP_MAX_MOODS:
+                moods = dict(sorted(moods.items(), key=lambda item: -item[1])[:ROLLUP_MAX_MOODS])
+            txn.set(rollup_ref, {'email': email, 'moods': moods,
+                                 'searches': rollup.get('searches', 0) + len(dropped),
+                                 'updated': firestore.SERVER_TIMESTAMP})
+    return len(dropped)
+
+@job_queue.handler('purge_history')
+def purge_history(compact=False):
+    # Expired entries are found oldest-first from the timestamp index, a page at a time.
+    # compact=True also trims users over the cap (history written before it existed).
+    history = db.collection('search_history')
+    dropped = 0
+    if compact:
+        counts = {}
+        for doc in history.stream():
+            email = doc.peek().get('email')
+            counts[email] = counts.get(email, 0) + 1
+        for email, count in counts.items():
+            if count > HISTORY_PER_USER:
+                dropped += trim_history(email)
+    cutoff = history_cutoff()
+    while cutoff:
+        oldest = history.order_by('timestamp', direction=firestore.Query.ASCENDING).limit(500).stream()
+        emails = {d.get('email') for d in (doc.peek() for doc in oldest) if str(d.get('timestamp', '')) < cutoff}
+        trimmed = sum(trim_history(email) for email in emails)
+        dropped += trimmed
+        if not trimmed:
+            break
+    if dropped:
+        print(f"DEBUG: Rolled up {dropped} search_history entries")
+    return dropped
+
+_last_history_purge = time.monotonic()
+_history_purge_lock = threading.Lock()
+
+def schedule_history_purge():
+    global _last_history_purge
+    if history_cutoff() is None:
+        return # nothing expires; the cap is enforced on every write
+    with _history_purge_lock:
+        if time.monotonic() - _last_history_purge < HISTORY_PURGE_INTERVAL:
+            return
+        _last_history_purge = time.monotonic()
+    job_queue.submit('purge_history', {})
+
 @app.route('/api/recommend', methods=['POST'])
 def recommend():
     # if not db: return jsonify({'error': 'Database unavailable'}), 500
@@ -316,104 +704,165 @@ def recommend():
 
     movies = []
     explanation = ""
-    use_tmdb = TMDB_API_KEY and len(TMDB_API_KEY) > 20 and "YOUR_TMDB_API_KEY" not in TMDB_API_KEY
+    deadline = deadline_in(RECOMMEND_BUDGET)
+    use_tmdb = use_tmdb_enabled()
+
+    cached = recommendation_cache.get(mood)
+    if cached is not MISS:
+        movies, explanation = cached['movies'], mood_explanation(mood)
+    elif LOCAL_RECOMMENDER == 'first':
+        movies, explanation = local_recommendations(mood, email)
 
     # AI Recommendation Logic
-    if OPENROUTER_API_KEY:
+    if OPENROUTER_API_KEY and not movies:
         try:
             print("DEBUG: Asking OpenRouter (Grok) for recommendations...")
-            prompt = f"""
-            Act as a movie expert. The user is feeling: "{mood}".
-            Suggest 5 movies that perfectly match this emotional state or theme.
-            Return ONLY a raw JSON array of objects: [ {{"title": "Title", "reason": "Reason"}} ]
-            """
-            
-            models_to_try = ["openrouter/free", "google/gemini-2.0-flash-exp:free", "mistralai/mistral-7b-instruct:free"]
-            
-            for model in models_to_try:
-                try:
-                    url = "https://openrouter.ai/api/v1/chat/completions"
-                    headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {OPENROUTER_API_KEY}', 'HTTP-Referer': 'http://localhost:5173', 'X-Title': 'MovieGuru'}
-                    payload = {"messages": [{"role": "system", "content": "You are a helpful movie expert."}, {"role": "user", "content": prompt}], "model": model, "temperature": 0.7}
-                    
-                    response = requests.post(url, headers=headers, json=payload)
-                    if response.status_code == 200:
-                        clean_json = response.json()['choices'][0]['message']['content'].replace('```json', '').replace('```', '').strip()
-                        import re
-                        match = re.search(r'\[.*\]', clean_json, re.DOTALL)
-                        if match:
-                            recommendations = json.loads(match.group(0))
-                            explanation = f"Here are some picks for your mood: '{mood}'"
-                            
-                            for rec in recommendations:
-                                title = rec.get('title')
-                                reason = rec.get('reason')
-                                
-                                if use_tmdb:
-                                    tmdb_res = requests.get(f"{TMDB_BASE_URL}/search/movie", params={'api_key': TMDB_API_KEY, 'query': title})
-                                    if tmdb_res.status_code == 200 and tmdb_res.json().get('results'):
-                                        m = tmdb_res.json().get('results')[0]
-                                        movies.append({'id': m['id'], 'title': m['title'], 'poster_path': m.get('poster_path'), 'overview': m.get('overview'), 'vote_average': m.get('vote_average'), 'ai_reason': reason, 'release_date': m.get('release_date')})
-                                elif OMDB_API_KEY:
-                                    # OMDb fallback
-                                    try:
-                                        omdb_res = requests.get(OMDB_URL, params={'apikey': OMDB_API_KEY, 't': title, 'type': 'movie'})
-                                        if omdb_res.status_code == 200:
-                                            m = omdb_res.json()
-                                            if m.get('Response') == 'True':
-                                                poster = m.get('Poster')
-                                                if poster == 'N/A': poster = None
-                                                try:
-                                                    rating = float(m.get('imdbRating', 0))
-                                                except:
-                                                    rating = 0.0
-                                                movies.append({
-                                                    'id': m.get('imdbID'),
-                                                    'title': m.get('Title'),
-                                                    'poster_path': poster,
-                                                    'overview': m.get('Plot'),
-                                                    'vote_average': rating, 
-                                                    'ai_reason': reason,
-                                                    'release_date': m.get('Released')
-                                                })
-                                    except Exception as e:
-                                        print(f"OMDb Error for {title}: {e}")
-                            
-                            if movies: break
-                except Exception as e:
-                     print(f"Model {model} failed: {e}")
+            prompt = build_recommend_prompt(mood)
+
+            def ask(model):
+                return recommendations_from_response(openrouter_call(model, prompt, deadline))
+
+            with metrics.timed('llm'):
+                model, recommendations = model_router.run(ask, deadline)
+            if recommendations:
+                print(f"DEBUG: Using recommendations from {model}")
+                explanation = mood_explanation(mood)
+                
+                with metrics.timed('enrich'):
+                    movies = enrich_recommendations(recommendations, use_tmdb, deadline=deadline)
+                
+                if movies:
+                    recommendation_cache.set(mood, {'movies': movies})
 
         except Exception as e:
             print(f"AI Error: {e}")
 
     # Fallback
-    if not movies and use_tmdb:
-         try:
-            tmdb_res = requests.get(f"{TMDB_BASE_URL}/search/movie", params={'api_key': TMDB_API_KEY, 'query': mood})
-            if tmdb_res.status_code == 200:
-                for m in tmdb_res.json().get('results', [])[:5]:
-                     movies.append({'id': m['id'], 'title': m['title'], 'poster_path': m.get('poster_path'), 'overview': m.get('overview'), 'vote_average': m.get('vote_average')})
-         except: pass
-         
     if not movies:
-        movies = get_mock_movies()
-        explanation = "We couldn't connect services, but try these favorites!"
+        with metrics.timed('fallback'):
+            movies, explanation = fallback_movies(mood, use_tmdb, deadline, email)
 
     # SAVE TO HISTORY
-    if db:
-        try:
-            if email:
-                db.collection('search_history').add({
-                    'mood': mood,
-                    'result_count': len(movies),
-                    'email': email,
-                    'timestamp': firestore.SERVER_TIMESTAMP
-                })
-        except Exception as e:
-            print(f"History Save Error: {e}")
+    save_history(mood, movies, email)
 
     return jsonify({'mood': mood, 'explanation': explanation, 'movies': movies})
 
+def stream_ai_recommendations(mood, use_tmdb, deadline):
+    """Yield ('title' | 'movie', payload) events as a streamed model reply is parsed.
+
+    A reader thread consumes the OpenRouter token stream and submits each
+    title to the enrichment pool the moment its JSON object is complete;
+    movies are yielded in the order their lookups finish, tagged with their
+    index in the model's list.
+    """
+    events = queue.Queue()
+    prompt = build_recommend_prompt(mood)
+
+    def submit(index, rec):
+        events.put(('pending', None))
+        events.put(('title', {'index': index, 'title': rec.get('title'), 'reason': rec.get('reason')}))
+        future = enrich_pool.submit(enrich_movie, rec.get('title'), rec.get('reason'), use_tmdb, deadline, rec.get('year'))
+        future.add_done_callback(lambda f: events.put(('resolved', (index, rec, f))))
+
+    def read_model_stream():
+        try:
+            # Streams can't be raced without duplicating picks, so models are tried
+            # in turn, in the router's health order, and feed its stats
+            for model in model_router.ordered_models():
+                if not model_router.admit(model):
+                    continue
+                found = 0
+                start = time.monotonic()
+                try:
+                    response = openrouter_call(model, prompt, deadline, stream=True)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"HTTP {response.status_code}")
+                    parser = JsonArrayStream()
+                    with response:
+                        for text in iter_chat_deltas(response.iter_lines()):
+                            for rec in parser.feed(text):
+                                submit(found, rec)
+                                found += 1
+                            if parser.finished: break
+                except Exception as e:
+                    print(f"Model {model} stream failed: {e}")
+                model_router.record(model, found > 0, time.monotonic() - start)
+                if found: break
+        finally:
+            events.put(('llm_done', None))
+
+    threading.Thread(target=read_model_stream, daemon=True).start()
+    pending, llm_done = 0, False
+    while not llm_done or pending:
+        try:
+            kind, value = events.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            print("Streaming recommendation hit its deadline")
+            return
+        if kind == 'pending':
+            pending += 1
+        elif kind == 'llm_done':
+            llm_done = True
+        elif kind == 'title':
+            yield 'title', value
+        elif kind == 'resolved':
+            pending -= 1
+            index, rec, future = value
+            if future.exception():
+                print(f"Metadata lookup failed for {rec.get('title')}: {future.exception()}")
+            elif future.result():
+                yield 'movie', {'index': index, 'movie': future.result()}
+
+@app.route('/api/recommend/stream', methods=['GET', 'POST'])
+def recommend_stream():
+    """Server-Sent Events variant of /api/recommend.
+
+    Emits `meta` first, a `title` per model pick as soon as it is parsed,
+    a `movie` ({index, movie}) per pick as soon as its metadata resolves,
+    and finally `done`. GET (?mood=&email=) works with EventSource.
+    """
+    data = request.get_json(silent=True) or request.args
+    mood = data.get('mood')
+    email = data.get('email')
+
+    if not mood:
+        return jsonify({'error': 'Mood is required'}), 400
+
+    deadline = deadline_in(RECOMMEND_BUDGET)
+    use_tmdb = use_tmdb_enabled()
+
+    def generate():
+        cached = recommendation_cache.get(mood)
+        if cached is not MISS:
+            explanation, movies = mood_explanation(mood), cached['movies']
+            yield sse_event('meta', {'mood': mood, 'explanation': explanation, 'cached': True})
+            for index, movie in enumerate(movies):
+                yield sse_event('movie', {'index': index, 'movie': movie})
+        else:
+            explanation = mood_explanation(mood)
+            yield sse_event('meta', {'mood': mood, 'explanation': explanation, 'cached': False})
+            resolved = []
+            if OPENROUTER_API_KEY:
+                for event, payload in stream_ai_recommendations(mood, use_tmdb, deadline):
+                    if event == 'movie':
+                        resolved.append((payload['index'], payload['movie']))
+                    yield sse_event(event, payload)
+            movies = [movie for _, movie in sorted(resolved, key=lambda item: item[0])]
+            if movies:
+                recommendation_cache.set(mood, {'movies': movies})
+            else:
+                movies, explanation = fallback_movies(mood, use_tmdb, deadline, email)
+                yield sse_event('meta', {'mood': mood, 'explanation': explanation, 'cached': False})
+                for index, movie in enumerate(movies):
+                    yield sse_event('movie', {'index': index, 'movie': movie})
+
+        save_history(mood, movies, email)
+        yield sse_event('done', {'mood': mood, 'explanation': explanation, 'count': len(movies)})
+
+    # X-Accel-Buffering stops nginx from holding events back
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/favorites', methods=['POST'])
 def favorites():
     # if not db: return jsonify({'error': 'Database unavailable'}), 500
@@ -423,32 +872,36 @@ def favorites():
     if not email: return jsonify({'error': 'Email required'}), 400
 
     user_ref = get_user_ref(email)
-    doc = user_ref.get()
-    
-    if not doc.exists:
-         return jsonify({'error': 'User not found'}), 404
-    
-    user_data = doc.to_dict()
-    current_favs = user_data.get('favorites', [])
-    
-    if data.get('action') == 'get':
-         return jsonify(current_favs)
-
-    # Toggle
     movie = data.get('movie')
-    if not movie: return jsonify({'error': 'Movie data required'}), 400
-    
-    # Check if exists (by ID) -- Flexible for int vs str ids
-    existing_index = next((index for (index, d) in enumerate(current_favs) if str(d.get("id")) == str(movie.get("id"))), None)
-    
-    if existing_index is not None:
-        current_favs.pop(existing_index)
-        status = 'removed'
-    else:
-        current_favs.append(movie)
-        status = 'added'
-        
-    user_ref.update({'favorites': current_favs})
+
+    # Read and toggle under the users collection lock so concurrent toggles can't drop each other
+    with db.transaction() as txn:
+        doc = txn.get(user_ref)
+
+        if not doc.exists:
+             return jsonify({'error': 'User not found'}), 404
+
+        user_data = doc.to_dict()
+        current_favs = list(user_data.get('favorites', []))
+
+        if data.get('action') == 'get':
+             return jsonify(current_favs)
+
+        # Toggle
+        if not movie: return jsonify({'error': 'Movie data required'}), 400
+
+        # Check if exists (by ID) -- Flexible for int vs str ids
+        existing_index = next((index for (index, d) in enumerate(current_favs) if str(d.get("id")) == str(movie.get("id"))), None)
+
+        if existing_index is not None:
+            current_favs.pop(existing_index)
+            status = 'removed'
+        else:
+            current_favs.append(movie)
+            status = 'added'
+
+        txn.update(user_ref, {'favorites': current_favs})
+
     return jsonify({'status': status, 'favorites': current_favs})
 
 @app.route('/api/history', methods=['GET'])
@@ -459,23 +912,52 @@ def history():
     
     try:
         history_ref = db.collection('search_history')
-        query = history_ref.where('email', '==', email).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(20)
-        docs = query.stream()
-        
-        result = []
-        for doc in docs:
-            d = doc.to_dict()
-            # Clean up timestamp for frontend
-            if d.get('timestamp'):
-                d['timestamp'] = str(d['timestamp'])
-            d['id'] = doc.id
-            result.append(d)
-            
-        return jsonify(result)
+
+        def build():
+            query = history_ref.where('email', '==', email).order_by('timestamp', direction=firestore.Query.DESCENDING)
+            docs, next_cursor, paginated = paginate(query, 20)
+
+            # Stored records already carry their id; only copy to clean up a non-string timestamp
+            result = []
+            for doc in docs:
+                d = doc.peek()
+                if d.get('timestamp') and not isinstance(d['timestamp'], str):
+                    d = {**d, 'timestamp': str(d['timestamp'])}
+                result.append(d)
+
+            if paginated:
+                return {'items': result, 'next_cursor': next_cursor}
+            return result
+
+        key = ('history', email, request.args.get('page_size'), request.args.get('cursor'))
+        try:
+            return cached_json(key, history_ref.version(), build, cache_control='private, no-cache')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"History Error: {e}")
         return jsonify([])
 
+@app.route('/api/history/moods', methods=['GET'])
+def history_moods():
+    # Mood counts over the user's whole history: rolled-up totals plus the entries still kept
+    email = request.args.get('email')
+    if not email: return jsonify({'moods': [], 'searches': 0})
+    try:
+        rollup = db.collection('history_rollups').document(email).get().to_dict()
+        moods = dict(rollup.get('moods', {}))
+        searches = rollup.get('searches', 0)
+        for doc in db.collection('search_history').where('email', '==', email).stream():
+            key = normalize_mood(doc.peek().get('mood'))
+            if key:
+                moods[key] = moods.get(key, 0) + 1
+            searches += 1
+        ranked = sorted(moods.items(), key=lambda item: (-item[1], item[0]))
+        return jsonify({'moods': [{'mood': mood, 'count': count} for mood, count in ranked], 'searches': searches})
+    except Exception as e:
+        print(f"History Moods Error: {e}")
+        return jsonify({'moods': [], 'searches': 0})
+
 @app.route('/api/history/<history_id>', methods=['DELETE'])
 def delete_history(history_id):
     try:
@@ -484,6 +966,16 @@ def delete_history(history_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'movie_metadata': movie_cache.stats(), 'recommendations': recommendation_cache.stats(),
+                    'responses': response_cache.stats(), 'models': model_router.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Prometheus text exposition format, for this worker process
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # --- Posts API ---
 
 @app.route('/api/posts', methods=['GET'])
@@ -491,15 +983,24 @@ def get_posts():
     # if not db: return jsonify({'error': 'Database unavailable'}), 500
     try:
         posts_ref = db.collection('posts')
-        query = posts_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(50)
-        docs = query.stream()
-        
-        posts = []
-        for doc in docs:
-             p = doc.to_dict()
-             p['id'] = doc.id
-             posts.append(p)
-        return jsonify(posts)
+
+        def build():
+            query = posts_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
+            docs, next_cursor, paginated = paginate(query, 50)
+
+            # Serialised straight from the stored records (they carry their own id)
+            posts = with_profile_icons([doc.peek() for doc in docs])
+            if paginated:
+                return {'items': posts, 'next_cursor': next_cursor}
+            return posts
+
+        # Icons come from users at read time, so an icon change invalidates the feed too
+        version = (posts_ref.version(), db.collection('counters').version())
+        key = ('posts', request.args.get('page_size'), request.args.get('cursor'))
+        try:
+            return cached_json(key, version, build)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Get Posts Error: {e}")
         return jsonify([])
@@ -511,45 +1012,75 @@ def create_post():
     email = data.get('email')
     movie_title = data.get('movieTitle')
     content = data.get('content')
-    rating = data.get('rating', 5)
-    anonymous = data.get('anonymous', False)
-    profile_icon = data.get('profileIcon', '👤')
     
     if not all([email, movie_title, content]):
         return jsonify({'error': 'Missing required fields'}), 400
     
-    movie_poster = None
-    movie_year = None
-    movie_plot = None
-    try:
-        if OMDB_API_KEY:
-            omdb_res = requests.get(OMDB_URL, params={'apikey': OMDB_API_KEY, 't': movie_title, 'type': 'movie'})
-            if omdb_res.status_code == 200:
-                 md = omdb_res.json()
-                 if md.get('Response') == 'True':
-                     movie_poster = md.get('Poster') if md.get('Poster') != 'N/A' else None
-                     movie_year = md.get('Year')
-                     movie_plot = md.get('Plot')
-    except: pass
+    new_post = submit_post(data)
     
-    new_post = {
+    return jsonify(new_post), 201
+
+def submit_post(data):
+    # Stored right away (with catalog metadata when the title is known); otherwise
+    # the OMDb poster/year/plot are patched in by a background job
+    md = post_metadata_from_catalog(data.get('movieTitle'))
+    new_post = insert_post(build_post(data, md))
+    if not md and OMDB_API_KEY:
+        job_queue.submit('enrich_post', {'post_id': new_post['id'], 'title': data.get('movieTitle')})
+    return new_post
+
+@job_queue.handler('enrich_post')
+def enrich_post(post_id, title):
+    md = lookup_omdb(title) # network errors raise, so the job is retried
+    if md:
+        # Skip if the title was edited in the meantime
+        get_post_ref(post_id).update(lambda post: post_metadata(md) if post.get('movieTitle') == title else {})
+
+def post_metadata_from_catalog(title):
+    # The OMDb fields build_post reads, from the offline catalog (None on a miss)
+    m = lookup_catalog(title)
+    if not m:
+        return None
+    poster = m.get('poster_path')
+    if poster and not poster.startswith('http'):
+        poster = TMDB_IMAGE_BASE_URL + poster
+    return {'Poster': poster or 'N/A', 'Year': (m.get('release_date') or '')[:4] or None, 'Plot': m.get('overview')}
+
+def post_metadata(md):
+    # Post fields from an OMDb record (or None)
+    md = md or {}
+    return {
+        'moviePoster': md.get('Poster') if md.get('Poster') != 'N/A' else None,
+        'movieYear': md.get('Year'),
+        'moviePlot': md.get('Plot'),
+    }
+
+def build_post(data, md):
+    # New post document from the request body plus optional OMDb metadata
+    email = data.get('email')
+    movie_title = data.get('movieTitle')
+    content = data.get('content')
+    rating = data.get('rating', 5)
+    anonymous = data.get('anonymous', False)
+    profile_icon = data.get('profileIcon', '👤')
+
+    return {
         'author': email,
         'movieTitle': movie_title,
         'content': content,
         'rating': rating,
         'anonymous': anonymous,
         'profileIcon': profile_icon,
-        'moviePoster': movie_poster,
-        'movieYear': movie_year,
-        'moviePlot': movie_plot,
+        **post_metadata(md),
         'timestamp': datetime.datetime.now().isoformat(),
+        'commentCount': 0,
         'comments': []
     }
-    
+
+def insert_post(new_post):
     update_time, doc_ref = db.collection('posts').add(new_post)
     new_post['id'] = doc_ref.id
-    
-    return jsonify(new_post), 201
+    return new_post
 
 @app.route('/api/posts/<post_id>', methods=['PUT'])
 def edit_post(post_id):
@@ -575,7 +1106,7 @@ def edit_post(post_id):
     if updates:
         doc_ref.update(updates)
         
-    return jsonify({**post, **updates})
+    return jsonify(with_profile_icons([{**post, **updates}])[0])
 
 @app.route('/api/posts/<post_id>', methods=['DELETE'])
 def delete_post(post_id):
@@ -583,18 +1114,43 @@ def delete_post(post_id):
     data = request.json
     email = data.get('email')
     
-    doc_ref = db.collection('posts').document(post_id)
-    doc = doc_ref.get()
-    
-    if not doc.exists:
-        return jsonify({'error': 'Post not found'}), 404
-    
-    if doc.to_dict()['author'] != email:
-        return jsonify({'error': 'Unauthorized'}), 403
-    
-    doc_ref.delete()
+    posts = db.collection('posts')
+    comments = db.collection('comments')
+    doc_ref = posts.document(post_id)
+
+    # Post and its comments go in one transaction (both locked up front, as in add_comment)
+    with db.transaction() as txn:
+        txn.lock(comments, posts)
+        doc = txn.get(doc_ref)
+
+        if not doc.exists:
+            return jsonify({'error': 'Post not found'}), 404
+
+        if doc.to_dict()['author'] != email:
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        for comment in comments.where('post_id', '==', post_id).stream():
+            txn.delete(comment)
+        txn.delete(doc_ref)
     return jsonify({'message': 'Post deleted'})
 
+@app.route('/api/posts/<post_id>/comments', methods=['GET'])
+def get_comments(post_id):
+    # Oldest first; ?page_size= / ?cursor= page through the full thread
+    if not get_post_ref(post_id).get().exists:
+        return jsonify({'error': 'Post not found'}), 404
+
+    query = db.collection('comments').where('post_id', '==', post_id).order_by('timestamp', direction=firestore.Query.ASCENDING)
+    try:
+        docs, next_cursor, paginated = paginate(query, 50)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    comments = with_profile_icons([doc.peek() for doc in docs])
+    if paginated:
+        return jsonify({'items': comments, 'next_cursor': next_cursor})
+    return jsonify(comments)
+
 @app.route('/api/posts/<post_id>/comments', methods=['POST'])
 def add_comment(post_id):
     # if not db: return jsonify({'error': 'Database unavailable'}), 500
@@ -603,27 +1159,37 @@ def add_comment(post_id):
     content = data.get('content')
     profile_icon = data.get('profileIcon', '👤')
     
-    doc_ref = db.collection('posts').document(post_id)
-    doc = doc_ref.get()
-    
-    if not doc.exists: return jsonify({'error': 'Post not found'}), 404
-    
-    import uuid
-    comment_id = str(uuid.uuid4())
-    new_comment = {
-        'id': comment_id,
-        'author': email,
-        'content': content,
-        'profileIcon': profile_icon,
-        'timestamp': datetime.datetime.now().isoformat()
-    }
-    
-    doc_ref.update({
-        'comments': firestore.ArrayUnion([new_comment])
-    })
+    posts = db.collection('posts')
+    comments = db.collection('comments')
+    doc_ref = posts.document(post_id)
+
+    with db.transaction() as txn:
+        txn.lock(comments, posts)
+        doc = txn.get(doc_ref)
+
+        if not doc.exists: return jsonify({'error': 'Post not found'}), 404
+
+        comment_id = str(uuid.uuid4())
+        new_comment = {
+            'id': comment_id,
+            'post_id': post_id,
+            'author': email,
+            'content': content,
+            'profileIcon': profile_icon,
+            'timestamp': datetime.datetime.now().isoformat()
+        }
+        txn.set(comments.document(comment_id), new_comment)
+        # The post only keeps the count and the latest COMMENT_PREVIEW comments
+        txn.update(doc_ref, lambda post: {
+            'commentCount': post.get('commentCount', 0) + 1,
+            'comments': (post.get('comments', []) + [dict(new_comment)])[-COMMENT_PREVIEW:],
+        })
     
     return jsonify(new_comment), 201
 
 if __name__ == '__main__':
+    # The debug reloader re-runs this file in a child process, which is the one serving
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        startup()
     port = int(os.environ.get('PORT', 5001))
     app.run(port=port, debug=True)
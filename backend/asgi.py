@@ -0,0 +1,241 @@
+"""
+ASGI entry point. The I/O-bound endpoints (POST /api/recommend, POST
+/api/posts) run as native async handlers that await their upstream calls,
+so one worker can hold hundreds of in-flight recommendations. Every other
+route is the regular Flask app, run on a thread pool, so DB endpoints stay
+responsive while the LLM is thinking.
+
+    uvicorn asgi:app --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker --workers 3 asgi:app
+
+app.py still works as a plain WSGI app (gunicorn app:app); both modes
+share its caches, model health and database.
+"""
+import os
+import json
+import time
+import asyncio
+from a2wsgi import WSGIMiddleware
+import app as core
+import metrics
+from caches import MISS
+from http_client import AsyncUpstreamClient, deadline_in
+
+# Threads for the Flask routes (including the SSE stream, which holds one for its duration)
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", 32))
+flask_app = WSGIMiddleware(core.app, workers=WSGI_THREADS)
+
+# Async twins of app.py's clients, created on first use so they bind to the server's event loop
+SYNC_CLIENTS = {'openrouter': core.openrouter_client, 'tmdb': core.tmdb_client, 'omdb': core.omdb_client}
+_clients = {}
+
+def client(name):
+    if name not in _clients:
+        sync = SYNC_CLIENTS[name]
+        _clients[name] = AsyncUpstreamClient(
+            name, connect_timeout=sync.connect_timeout, read_timeout=sync.read_timeout,
+            retries=sync.retries, backoff=sync.backoff, budget=sync.budget,
+        )
+    return _clients[name]
+
+
+# --- Upstream lookups (same cache logic as app.py) ---
+async def lookup_tmdb(title, year=None, deadline=None):
+    key, params = core.tmdb_lookup_request(title, year)
+    cached = core.movie_cache.get(key)
+    if cached is not MISS:
+        return cached
+    response = await client('tmdb').get(f"{core.TMDB_BASE_URL}/search/movie", params=params, deadline=deadline)
+    return core.tmdb_lookup_result(key, response)
+
+async def lookup_omdb(title, year=None, deadline=None):
+    key, params = core.omdb_lookup_request(title, year)
+    cached = core.movie_cache.get(key)
+    if cached is not MISS:
+        return cached
+    return core.omdb_lookup_result(key, await client('omdb').get(core.OMDB_URL, params=params, deadline=deadline))
+
+async def enrich_movie(title, reason, use_tmdb, deadline=None, year=None):
+    # Catalog first, as in app.enrich_movie
+    local = core.lookup_catalog(title, year)
+    if local and local.get('poster_path'):
+        return core.movie_from_tmdb(local, reason)
+    try:
+        movie = await enrich_movie_online(title, reason, use_tmdb, deadline, year)
+    except Exception:
+        if not local:
+            raise
+        movie = None
+    return movie or (core.movie_from_tmdb(local, reason) if local else None)
+
+async def enrich_movie_online(title, reason, use_tmdb, deadline=None, year=None):
+    if use_tmdb:
+        m = await lookup_tmdb(title, year, deadline=deadline)
+        if m:
+            return core.movie_from_tmdb(m, reason)
+    elif core.OMDB_API_KEY:
+        m = await lookup_omdb(title, year, deadline=deadline)
+        if m:
+            return core.movie_from_omdb(m, reason)
+    return None
+
+async def enrich_recommendations(recommendations, use_tmdb, deadline=None):
+    # Concurrent lookups in the LLM's order; stragglers past ENRICH_TIMEOUT are dropped
+    if not recommendations:
+        return []
+    deadline = min(deadline or float('inf'), deadline_in(core.ENRICH_TIMEOUT))
+    tasks = [asyncio.ensure_future(enrich_movie(rec.get('title'), rec.get('reason'), use_tmdb, deadline, rec.get('year')))
+             for rec in recommendations]
+    done, pending = await asyncio.wait(tasks, timeout=max(0, deadline - time.monotonic()))
+    for task in pending:
+        task.cancel()
+
+    movies = []
+    for rec, task in zip(recommendations, tasks):
+        if task not in done:
+            print(f"Metadata lookup timed out for {rec.get('title')}")
+        elif task.exception():
+            print(f"Metadata lookup failed for {rec.get('title')}: {task.exception()}")
+        elif task.result():
+            movies.append(task.result())
+    return movies
+
+async def fallback_movies(mood, use_tmdb, deadline=None, email=None):
+    movies, explanation = await asyncio.to_thread(core.local_recommendations, mood, email)
+    if movies:
+        return movies, explanation
+    if use_tmdb:
+        try:
+            tmdb_res = await client('tmdb').get(f"{core.TMDB_BASE_URL}/search/movie",
+                                                params={'api_key': core.TMDB_API_KEY, 'query': mood}, deadline=deadline)
+            movies = core.fallback_search_movies(tmdb_res)
+        except Exception:
+            pass
+    return core.fallback_result(movies)
+
+
+# --- Async routes ---
+async def recommend(data):
+    mood = data.get('mood')
+    email = data.get('email')
+
+    if not mood:
+        return 400, {'error': 'Mood is required'}
+
+    movies = []
+    explanation = ""
+    deadline = deadline_in(core.RECOMMEND_BUDGET)
+    use_tmdb = core.use_tmdb_enabled()
+
+    cached = core.recommendation_cache.get(mood)
+    if cached is not MISS:
+        movies, explanation = cached['movies'], core.mood_explanation(mood)
+    elif core.LOCAL_RECOMMENDER == 'first':
+        movies, explanation = await asyncio.to_thread(core.local_recommendations, mood, email)
+
+    if core.OPENROUTER_API_KEY and not movies:
+        try:
+            prompt = core.build_recommend_prompt(mood)
+
+            async def ask(model):
+                headers, payload = core.openrouter_request(model, prompt)
+                response = await client('openrouter').post(core.OPENROUTER_URL, headers=headers, json=payload, deadline=deadline)
+                return core.recommendations_from_response(response)
+
+            with metrics.timed('llm'):
+                model, recommendations = await core.model_router.run_async(ask, deadline)
+            if recommendations:
+                print(f"DEBUG: Using recommendations from {model}")
+                explanation = core.mood_explanation(mood)
+                with metrics.timed('enrich'):
+                    movies = await enrich_recommendations(recommendations, use_tmdb, deadline=deadline)
+                if movies:
+                    core.recommendation_cache.set(mood, {'movies': movies})
+        except Exception as e:
+            print(f"AI Error: {e}")
+
+    if not movies:
+        with metrics.timed('fallback'):
+            movies, explanation = await fallback_movies(mood, use_tmdb, deadline, email)
+
+    # Only queues the write, but a persistent queue stores the job first: keep it off the event loop
+    await asyncio.to_thread(core.save_history, mood, movies, email)
+
+    return 200, {'mood': mood, 'explanation': explanation, 'movies': movies}
+
+async def create_post(data):
+    if not all([data.get('email'), data.get('movieTitle'), data.get('content')]):
+        return 400, {'error': 'Missing required fields'}
+
+    # Stored now; OMDb metadata is filled in by app.py's background job
+    new_post = await asyncio.to_thread(core.submit_post, data)
+    return 201, new_post
+
+ASYNC_ROUTES = {
+    ('POST', '/api/recommend'): recommend,
+    ('POST', '/api/posts'): create_post,
+}
+
+
+# --- ASGI plumbing ---
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def send_json(send, status, payload, headers=()):
+    body = core.app.json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('ascii')),
+            (b'access-control-allow-origin', b'*'), # same as flask_cors' default
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.to_thread(core.startup)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for upstream in _clients.values():
+                await upstream.aclose()
+            _clients.clear()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    handler = ASYNC_ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        return await flask_app(scope, receive, send)
+
+    # uvicorn runs each request in its own task, so the timer context is per request
+    token = metrics.start_request()
+    try:
+        data = json.loads(await read_body(receive) or b'null')
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        status, payload = 400, {'error': 'Invalid JSON body'}
+    else:
+        try:
+            status, payload = await handler(data)
+        except Exception:
+            metrics.finish_request(token, scope['path'], scope['method'], 500)
+            raise
+    timer = metrics.finish_request(token, scope['path'], scope['method'], status)
+    await send_json(send, status, payload, headers=[
+        (b'server-timing', timer.server_timing().encode('ascii')),
+        (b'timing-allow-origin', b'*'),
+    ])
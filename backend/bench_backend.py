@@ -0,0 +1,409 @@
+"""
+Load test for the whole backend against stub upstreams.
+
+Seeds a data directory with synthetic users, posts, comments and search
+history, starts the app in a child process pointed at local stand-ins for
+OpenRouter, TMDB and OMDb (stub_upstreams.py), drives a mixed workload
+from concurrent clients and reports throughput and p50/p95/p99 latency per
+route. Each --config runs against a fresh copy of the same seed data, so
+storage backends and cache settings can be compared side by side:
+
+    python bench_backend.py --scale 100000 --duration 30 --concurrency 16 \\
+        --config json --config wal --config sqlite --config json+nocache
+
+A config is presets joined with '+' (see PRESETS), optionally followed by
+':KEY=VALUE,...' environment overrides for the app, e.g.
+'sqlite:RESPONSE_CACHE_MAX_ENTRIES=100' or 'wal+asgi:JOB_WORKERS=4'.
+Seed data is generated once per scale and kept in --seed-dir.
+
+Every stub model here has the same latency and failure rate, so hedged
+model fallback has nothing to win; test_openrouter.py benchmarks that on
+its own, with per-model latencies and failure rates.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import datetime
+import threading
+import subprocess
+import requests
+
+from stub_upstreams import StubUpstreams, STUB_MOVIES
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Environment for the app, by preset name
+PRESETS = {
+    'json': {'MOVIEGURU_DB_STORAGE': 'json'},
+    'wal': {'MOVIEGURU_DB_STORAGE': 'wal'},
+    'sqlite': {'MOVIEGURU_DB_STORAGE': 'sqlite'},
+    'nocache': {'MOVIE_CACHE_MAX_ENTRIES': '0', 'RECOMMEND_CACHE_MAX_ENTRIES': '0', 'RESPONSE_CACHE_MAX_ENTRIES': '0'},
+    'similar': {'RECOMMEND_CACHE_SIMILARITY': '0.85'}, # near-match mood caching, off by default
+    'sequential': {'LLM_STRATEGY': 'sequential'}, # plain model fallback instead of hedged racing
+    'asgi': {'BENCH_SERVER': 'asgi'}, # uvicorn + asgi.py instead of the threaded WSGI server
+    'persistjobs': {'JOB_QUEUE_PERSIST': '1'},
+}
+
+# Relative weights of each operation in the mixed workload (--mix overrides)
+DEFAULT_MIX = {'feed': 30, 'history': 20, 'comments': 15, 'recommend': 10, 'login': 10,
+               'post': 5, 'comment': 5, 'favorite': 5}
+
+MOOD_WORDS = ['happy', 'sad', 'nostalgic', 'anxious', 'romantic', 'adventurous', 'cozy', 'angry', 'curious',
+              'lonely', 'hopeful', 'bored', 'tired', 'excited', 'thoughtful', 'scared']
+MOOD_EXTRAS = ['', 'and a bit tired', 'want something funny', 'rainy day', 'with friends', 'late at night',
+               'need a good cry', 'something in space', 'like a kid again', 'after a long week', 'date night',
+               'want to think']
+
+
+def moods(count):
+    # Distinct moods the clients pick from; fewer means more recommendation cache hits
+    pairs = [f"{word} {extra}".strip() for extra in MOOD_EXTRAS for word in MOOD_WORDS]
+    return pairs[:count]
+
+
+# --- Seed data ---
+def user_email(i):
+    return f"user{i}@bench.test"
+
+def seed(path, scale, rng):
+    """Write users, posts, comments and search_history JSON files for `scale` posts
+    and history entries (users: scale / 10, comments: scale / 2)."""
+    os.makedirs(path, exist_ok=True)
+    users_count = max(10, scale // 10)
+    now = datetime.datetime.now()
+    def stamp(seconds_ago):
+        return (now - datetime.timedelta(seconds=seconds_ago)).isoformat()
+    window = 30 * 24 * 3600 # everything inside the last 30 days, so history retention keeps it
+
+    users = {user_email(i): {'password': 'bench', 'favorites': [], 'profileIcon': '👤', 'createdAt': stamp(window)}
+             for i in range(users_count)}
+
+    posts = []
+    for i in range(scale):
+        movie = rng.choice(STUB_MOVIES)
+        posts.append({'id': f'post-{i}', 'author': user_email(rng.randrange(users_count)), 'movieTitle': movie['title'],
+                      'content': f"Benchmark review {i} of {movie['title']}", 'rating': rng.randint(1, 5),
+                      'anonymous': False, 'moviePoster': f"https://example.invalid/{movie['id']}.jpg",
+                      'movieYear': movie['year'], 'moviePlot': movie['overview'],
+                      'timestamp': stamp(window * (scale - i) / scale), 'commentCount': 0, 'comments': []})
+
+    comments = []
+    for i in range(scale // 2):
+        post = posts[rng.randrange(scale)]
+        comment = {'id': f'comment-{i}', 'post_id': post['id'], 'author': user_email(rng.randrange(users_count)),
+                   'content': f"Benchmark comment {i}", 'profileIcon': '👤',
+                   'timestamp': stamp(rng.uniform(0, window))}
+        comments.append(comment)
+        post['commentCount'] += 1
+        post['comments'] = (post['comments'] + [comment])[-3:]
+
+    mood_pool = moods(len(MOOD_WORDS) * len(MOOD_EXTRAS))
+    history = [{'id': str(uuid.UUID(int=rng.getrandbits(128))), 'mood': rng.choice(mood_pool), 'result_count': 5,
+                'email': user_email(rng.randrange(users_count)), 'timestamp': stamp(window * (scale - i) / scale)}
+               for i in range(scale)]
+
+    for name, data in [('users', users), ('posts', posts), ('comments', comments), ('search_history', history)]:
+        with open(os.path.join(path, f'{name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+    return users_count
+
+
+def seeded(seed_dir, scale):
+    # Generate the seed for a scale once; later runs reuse it
+    path = os.path.join(seed_dir, f'scale-{scale}')
+    meta_path = os.path.join(path, 'bench.json')
+    if not os.path.exists(meta_path):
+        start = time.perf_counter()
+        users = seed(path, scale, random.Random(scale))
+        with open(meta_path, 'w') as f:
+            json.dump({'scale': scale, 'users': users}, f)
+        print(f"Seeded {scale} posts/history and {users} users in {time.perf_counter() - start:.1f}s -> {path}")
+    with open(meta_path) as f:
+        return path, json.load(f)
+
+
+# --- App server (child process) ---
+def serve(port):
+    # Runs in the child: the app reads its configuration from the environment at import
+    sys.path.insert(0, HERE)
+    if os.environ.get('BENCH_SERVER') == 'asgi':
+        import uvicorn
+        uvicorn.run('asgi:app', host='127.0.0.1', port=port, log_level='warning', access_log=False)
+    else:
+        import logging
+        from werkzeug.serving import make_server
+        import app
+        logging.getLogger('werkzeug').setLevel(logging.WARNING) # no per-request access log
+        app.startup() # uvicorn does this through the ASGI lifespan
+        make_server('127.0.0.1', port, app.app, threaded=True).serve_forever()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(env, startup_timeout, log_path):
+    port = free_port()
+    log = open(log_path, 'w')
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port)],
+                            env=env, cwd=HERE, stdout=log, stderr=subprocess.STDOUT)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app exited during startup (code {proc.returncode}), see {log_path}")
+        try:
+            if requests.get(f'{base}/api/cache/stats', timeout=1).ok:
+                return proc, base
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"app not ready after {startup_timeout}s, see {log_path}")
+
+
+# --- Workload ---
+class Client:
+    """One closed-loop client: picks an operation by weight, times it, repeats."""
+    def __init__(self, base, meta, mix, mood_pool, rng, conditional):
+        self.base = base
+        self.users = meta['users']
+        self.posts = meta['scale']
+        self.ops = list(mix)
+        self.weights = [mix[op] for op in self.ops]
+        self.mood_pool = mood_pool
+        self.rng = rng
+        self.conditional = conditional
+        self.etags = {} # url -> last ETag, sent back as If-None-Match like a browser would
+        self.session = requests.Session()
+
+    def user(self):
+        return user_email(self.rng.randrange(self.users))
+
+    def post_id(self):
+        return f'post-{self.rng.randrange(self.posts)}'
+
+    def request(self, method, path, **kwargs):
+        url = self.base + path
+        headers = {}
+        if self.conditional and method == 'GET' and url in self.etags:
+            headers['If-None-Match'] = self.etags[url]
+        response = self.session.request(method, url, headers=headers, timeout=120, **kwargs)
+        if response.headers.get('ETag'):
+            self.etags[url] = response.headers['ETag']
+        return response.status_code
+
+    def run_op(self, op):
+        rng = self.rng
+        if op == 'feed':
+            return self.request('GET', '/api/posts')
+        if op == 'history':
+            return self.request('GET', '/api/history', params={'email': self.user()})
+        if op == 'comments':
+            return self.request('GET', f'/api/posts/{self.post_id()}/comments')
+        if op == 'recommend':
+            return self.request('POST', '/api/recommend', json={'mood': rng.choice(self.mood_pool), 'email': self.user()})
+        if op == 'login':
+            return self.request('POST', '/api/login', json={'email': self.user(), 'password': 'bench'})
+        if op == 'post':
+            movie = rng.choice(STUB_MOVIES)
+            return self.request('POST', '/api/posts', json={'email': self.user(), 'movieTitle': movie['title'],
+                                                            'content': 'Benchmark post', 'rating': 4})
+        if op == 'comment':
+            return self.request('POST', f'/api/posts/{self.post_id()}/comments', json={'email': self.user(), 'content': 'Benchmark comment'})
+        if op == 'favorite':
+            movie = rng.choice(STUB_MOVIES)
+            return self.request('POST', '/api/favorites', json={'email': self.user(), 'movie': {'id': movie['id'], 'title': movie['title']}})
+        raise ValueError(f"Unknown operation: {op}")
+
+    def loop(self, stop_at, record_from, results):
+        while True:
+            op = self.rng.choices(self.ops, self.weights)[0]
+            start = time.perf_counter()
+            if start >= stop_at:
+                return
+            try:
+                status = self.run_op(op)
+            except requests.RequestException:
+                status = None
+            elapsed = time.perf_counter() - start
+            if start >= record_from: # warmup requests are not counted
+                results.append((op, elapsed, status))
+
+
+def percentile(sorted_values, p):
+    # Nearest rank
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))]
+
+def summarize(results, seconds):
+    by_op = {}
+    for op, elapsed, status in results:
+        by_op.setdefault(op, []).append((elapsed, status))
+    summary = {}
+    for op, samples in sorted(by_op.items()) + [('ALL', [(e, s) for _, e, s in results])]:
+        latencies = sorted(e for e, _ in samples)
+        errors = sum(1 for _, s in samples if s is None or s >= 400)
+        summary[op] = {
+            'requests': len(samples), 'rps': len(samples) / seconds, 'errors': errors,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+    return summary
+
+
+def run_config(label, env_overrides, args, seed_path, meta, stub):
+    data_dir = tempfile.mkdtemp(prefix='movieguru-bench-')
+    try:
+        for name in os.listdir(seed_path):
+            if name.endswith('.json') and name != 'bench.json':
+                shutil.copy(os.path.join(seed_path, name), data_dir)
+        env = {**os.environ, **stub.env(),
+               'OPENROUTER_API_KEY': 'stub-openrouter-key', 'TMDB_API_KEY': 'stub-tmdb-key-0000000000000000', 'OMDB_API_KEY': 'stub-omdb-key',
+               'MOVIEGURU_DATA_DIR': data_dir, 'MOVIE_CATALOG_PATH': os.path.join(data_dir, 'no-catalog.bin'),
+               **env_overrides}
+        started = time.perf_counter()
+        proc, base = start_server(env, args.startup_timeout, os.path.join(args.seed_dir, f'{label.replace(":", "_")}.log'))
+        try:
+            mood_pool = moods(args.moods)
+            rng = random.Random(args.random_seed)
+            clients = [Client(base, meta, args.mix, mood_pool, random.Random(rng.random()), args.conditional)
+                       for _ in range(args.concurrency)]
+            # Collections load (or import into SQLite) on first use: touch every route once
+            # so that lands in the startup time, not in the measurements
+            for op in DEFAULT_MIX:
+                clients[0].run_op(op)
+            startup = time.perf_counter() - started
+            results = []
+            now = time.perf_counter()
+            record_from, stop_at = now + args.warmup, now + args.warmup + args.duration
+            threads = [threading.Thread(target=c.loop, args=(stop_at, record_from, results)) for c in clients]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            summary = summarize(results, args.duration)
+            try:
+                caches = requests.get(f'{base}/api/cache/stats', timeout=10).json()
+            except (requests.RequestException, ValueError):
+                caches = {}
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+        return {'label': label, 'env': env_overrides, 'startup_s': startup, 'routes': summary, 'caches': caches}
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def parse_config(spec):
+    # "preset+preset:KEY=VALUE,KEY=VALUE" -> environment overrides
+    presets, _, overrides = spec.partition(':')
+    env = {}
+    for name in filter(None, presets.split('+')):
+        if name not in PRESETS:
+            raise argparse.ArgumentTypeError(f"unknown preset {name!r} (choose from {', '.join(PRESETS)})")
+        env.update(PRESETS[name])
+    for pair in filter(None, overrides.split(',')):
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {pair!r}")
+        env[key] = value
+    return spec, env
+
+def parse_mix(spec):
+    mix = {}
+    for pair in spec.split(','):
+        op, _, weight = pair.partition('=')
+        if op not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown operation {op!r} (choose from {', '.join(DEFAULT_MIX)})")
+        mix[op] = float(weight or 1)
+    return {op: w for op, w in mix.items() if w > 0}
+
+
+def print_report(run):
+    caches = run['caches']
+    print(f"\n== {run['label']}  (startup {run['startup_s']:.1f}s)")
+    print(f"{'route':>10} {'requests':>9} {'req/s':>8} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for op, s in run['routes'].items():
+        print(f"{op:>10} {s['requests']:>9} {s['rps']:>8.1f} {s['errors']:>7} {s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f}")
+    ratios = [f"{name} {stats.get('hit_ratio', 0):.0%}" for name, stats in caches.items() if isinstance(stats, dict) and 'hit_ratio' in stats]
+    if ratios:
+        print(f"{'':>10} cache hit ratio: {', '.join(ratios)}")
+
+def print_comparison(runs):
+    # One row per route, p50 / p99 and throughput for each config
+    labels = [run['label'] for run in runs]
+    width = max(24, max(len(label) for label in labels) + 2)
+    print("\n== Comparison (p50 / p99 ms, req/s)")
+    print(f"{'route':>10} " + ''.join(f"{label:>{width}}" for label in labels))
+    routes = sorted({op for run in runs for op in run['routes']}, key=lambda op: (op == 'ALL', op))
+    for op in routes:
+        cells = []
+        for run in runs:
+            s = run['routes'].get(op)
+            cells.append(f"{s['p50_ms']:.1f} / {s['p99_ms']:.1f}, {s['rps']:.0f}" if s else '-')
+        print(f"{op:>10} " + ''.join(f"{cell:>{width}}" for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--config', action='append', type=parse_config, help="preset[+preset][:KEY=VALUE,...], repeatable (default: json)")
+    parser.add_argument('--scale', type=int, default=1000, help='posts and history entries to seed (users: scale/10)')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds per config')
+    parser.add_argument('--warmup', type=float, default=3, help='unmeasured seconds before that')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='op=weight,... from: ' + ', '.join(DEFAULT_MIX))
+    parser.add_argument('--moods', type=int, default=100, help='distinct moods clients ask for')
+    parser.add_argument('--conditional', action='store_true', help='send If-None-Match like a browser')
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--tmdb-latency', type=float, default=0.1)
+    parser.add_argument('--omdb-latency', type=float, default=0.1)
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra uniform random upstream delay (s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='injected upstream failure rate, all upstreams')
+    parser.add_argument('--llm-failure-rate', type=float, default=None, help='override --failure-rate for the LLM')
+    parser.add_argument('--seed-dir', default=os.path.join(tempfile.gettempdir(), 'movieguru-bench'))
+    parser.add_argument('--startup-timeout', type=float, default=600)
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--json', metavar='PATH', help='also write the results as JSON')
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve)
+
+    configs = args.config or [parse_config('json')]
+    seed_path, meta = seeded(args.seed_dir, args.scale)
+    failure = {k: args.failure_rate for k in ('llm', 'tmdb', 'omdb')}
+    if args.llm_failure_rate is not None:
+        failure['llm'] = args.llm_failure_rate
+    runs = []
+    with StubUpstreams(latency={'llm': args.llm_latency, 'tmdb': args.tmdb_latency, 'omdb': args.omdb_latency},
+                       failure_rate=failure, jitter=args.jitter) as stub:
+        print(f"Stub upstreams at {stub.base_url}; {args.concurrency} clients, {args.duration:g}s per config, scale {args.scale}")
+        for label, env in configs:
+            before = dict(stub.counts)
+            run = run_config(label, env, args, seed_path, meta, stub)
+            run['upstream_calls'] = {k: stub.counts[k] - before[k] for k in before}
+            runs.append(run)
+            print_report(run)
+            print(f"{'':>10} upstream calls: {', '.join(f'{k} {v}' for k, v in run['upstream_calls'].items())}")
+            if not run['upstream_calls'].get('tmdb') and args.mix.get('recommend'):
+                # The app only enables TMDB for keys over 20 characters, so this would mean enrichment went unmeasured
+                print(f"{'':>10} WARNING: no TMDB calls, the enrichment path was not exercised")
+    if len(runs) > 1:
+        print_comparison(runs)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': {k: v for k, v in vars(args).items() if k not in ('config', 'serve')}, 'runs': runs}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
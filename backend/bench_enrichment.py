@@ -0,0 +1,64 @@
+"""
+Offline benchmark for the metadata enrichment step of /api/recommend.
+
+Runs enrich_recommendations() against a local stub TMDB with injected latency,
+once on a single-thread pool (the old sequential behaviour) and once on the
+app's bounded pool:
+
+    python bench_enrichment.py --latency 0.3 --slow-title Her --slow-delay 3 --runs 5
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from stub_upstreams import StubUpstreams, STUB_MOVIES
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.3, help='per-lookup TMDB latency (s)')
+    parser.add_argument('--slow-title', default=None, help='title that gets --slow-delay extra latency')
+    parser.add_argument('--slow-delay', type=float, default=3.0)
+    parser.add_argument('--timeout', type=float, default=None, help='override ENRICH_TIMEOUT (s)')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    slow = {args.slow_title: args.slow_delay} if args.slow_title else {}
+    with StubUpstreams(latency={'tmdb': args.latency}, slow_titles=slow) as stub, \
+            tempfile.TemporaryDirectory(prefix='movieguru-bench-') as data_dir:
+        # Configure the app before importing it; an empty data dir keeps it off the real JSON files
+        os.environ.update(stub.env())
+        os.environ['MOVIEGURU_DATA_DIR'] = data_dir
+        os.environ['MOVIE_CATALOG_PATH'] = os.path.join(data_dir, 'no-catalog.bin') # every lookup goes to the stub
+        os.environ['TMDB_API_KEY'] = 'stub-tmdb-key-for-local-benchmarks'
+        if args.timeout is not None:
+            os.environ['ENRICH_TIMEOUT'] = str(args.timeout)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import app
+
+        picks = [{'title': m['title'], 'reason': 'benchmark'} for m in STUB_MOVIES[:4]]
+        if args.slow_title:
+            picks.append({'title': args.slow_title, 'reason': 'benchmark'})
+        else:
+            picks.append({'title': STUB_MOVIES[4]['title'], 'reason': 'benchmark'})
+
+        sequential = ThreadPoolExecutor(max_workers=1)
+        for label, pool in [('sequential', sequential), (f'parallel ({app.ENRICH_WORKERS} workers)', app.enrich_pool)]:
+            timings = []
+            for _ in range(args.runs):
+                # Cold cache every run, or all but the first run only measure cache hits
+                app.movie_cache.clear()
+                start = time.perf_counter()
+                movies = app.enrich_recommendations(picks, use_tmdb=True, pool=pool)
+                timings.append(time.perf_counter() - start)
+            titles = [m['title'] for m in movies]
+            print(f"{label:>24}: best {min(timings) * 1000:7.1f} ms  "
+                  f"mean {sum(timings) / len(timings) * 1000:7.1f} ms  -> {len(movies)}/{len(picks)} {titles}")
+        sequential.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# Returned by TTLCache.get on a miss, so a cached None (negative entry) is distinguishable
+MISS = object()
+
+
+def normalize_title(title):
+    # 'The Dark Knight!' / ' the  dark knight ' -> 'the dark knight'
+    title = unicodedata.normalize('NFKD', title or '').encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', title.casefold()).split())
+
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry and a memory bound.
+
+    None values are negative entries ("looked it up, nothing there") and
+    expire after negative_ttl instead of ttl. Entry size is estimated from
+    the JSON encoding of the value.
+    """
+    def __init__(self, name, ttl=3600, negative_ttl=300, max_entries=2000, max_bytes=8 * 1024 * 1024):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, count=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                if count: self.misses += 1
+                return MISS
+            self._entries.move_to_end(key)
+            if count: self.hits += 1
+            return entry[2]
+
+    def set(self, key, value):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (self.ttl if value is not None else self.negative_ttl)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires_at, size, value)
+            self._bytes += size
+            # Evict least recently used entries until back within both bounds
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Filler that doesn't change what a mood means: "I'm feeling really sad" == "sad"
+MOOD_STOPWORDS = {
+    'i', 'im', 'am', 'me', 'my', 'feel', 'feeling', 'feels', 'felt', 'mood', 'today', 'right', 'now',
+    'so', 'very', 'really', 'quite', 'kinda', 'kind', 'of', 'a', 'bit', 'little', 'just', 'pretty', 'the',
+}
+
+# Words that flip what a mood means ("scary" vs "not scary"): near matches must agree on them
+MOOD_NEGATIONS = {'no', 'not', 'non', 'never', 'nothing', 'none', 'nor', 'without', 'dont', 'doesnt', 'isnt', 'cant', 'wont'}
+
+
+def normalize_mood(mood):
+    words = normalize_title((mood or '').replace("'", '')).split()
+    kept = [w for w in words if w not in MOOD_STOPWORDS]
+    return ' '.join(kept or words)
+
+
+def _char_ngrams(text, n=2):
+    padded = f' {text} '
+    grams = {}
+    for i in range(len(padded) - n + 1):
+        gram = padded[i:i + n]
+        grams[gram] = grams.get(gram, 0) + 1
+    norm = sum(c * c for c in grams.values()) ** 0.5
+    return grams, norm
+
+
+def _cosine(a, b):
+    (ga, na), (gb, nb) = a, b
+    if not na or not nb:
+        return 0.0
+    if len(ga) > len(gb):
+        ga, gb = gb, ga
+    return sum(c * gb.get(g, 0) for g, c in ga.items()) / (na * nb)
+
+
+class MoodCache:
+    """Recommendation cache keyed on the normalised mood string.
+
+    With similarity > 0, a miss on the exact key falls back to the cached
+    mood whose character-bigram vector is closest by cosine similarity,
+    provided it scores at least `similarity`, has the same number of words
+    and the same negation words (so typos and plurals match, "no action"
+    and "action" don't).
+    """
+    def __init__(self, name, ttl=1800, max_entries=500, similarity=0.0):
+        self.name = name
+        self.similarity = similarity
+        self._cache = TTLCache(name, ttl=ttl, negative_ttl=0, max_entries=max_entries,
+                               max_bytes=max_entries * 16 * 1024)
+        self._vectors = {} # normalised mood -> bigram vector
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def get(self, mood):
+        key = normalize_mood(mood)
+        value = self._cache.get(key, count=False)
+        if value is MISS and self.similarity > 0:
+            value = self._get_similar(key)
+            if value is not MISS:
+                with self._lock:
+                    self.similar_hits += 1
+                return value
+        with self._lock:
+            if value is MISS:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def _get_similar(self, key):
+        vector = _char_ngrams(key)
+        words = key.split()
+        negations = MOOD_NEGATIONS.intersection(words)
+        with self._lock:
+            candidates = list(self._vectors.items())
+        best_key, best_score = None, self.similarity
+        for other, other_vector in candidates:
+            other_words = other.split()
+            if len(other_words) != len(words) or MOOD_NEGATIONS.intersection(other_words) != negations:
+                continue
+            score = _cosine(vector, other_vector)
+            if score >= best_score:
+                best_key, best_score = other, score
+        if best_key is None:
+            return MISS
+        return self._cache.get(best_key, count=False)
+
+    def set(self, mood, value):
+        key = normalize_mood(mood)
+        self._cache.set(key, value)
+        with self._lock:
+            self._vectors[key] = _char_ngrams(key)
+            if len(self._vectors) > 2 * self._cache.max_entries:
+                # Forget vectors of moods the underlying cache has evicted
+                live = set(self._cache.keys())
+                self._vectors = {k: v for k, v in self._vectors.items() if k in live}
+
+    def stats(self):
+        stats = self._cache.stats()
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            stats.update({
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.similar_hits) / lookups, 4) if lookups else 0.0,
+            })
+        return stats
+
+
+class ResponseCache:
+    """Serialised response bodies, valid for as long as their source version.
+
+    Entries are (version, body, etag); a lookup with a different version is
+    a miss. The (unquoted) ETag is a hash of the body, so it is the same in
+    every worker process even though collection versions are per process.
+    """
+    def __init__(self, name, max_entries=1000):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (version, body, etag)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        # (body, etag), or None if missing or built from an older version
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, key, version, body):
+        etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        with self._lock:
+            self._entries[key] = (version, body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return body, etag
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'entries': len(self._entries),
+                'bytes': sum(len(entry[1]) for entry in self._entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,388 @@
+"""
+Offline movie catalog: title -> poster / year / plot / rating without a
+network call. Enrichment (app.enrich_movie) and new posts look titles up
+here first and only ask TMDB / OMDb on a miss.
+
+Build it once from a dataset dump; sources can be mixed and gzipped:
+
+    python catalog.py build catalog.bin tmdb_movies.jsonl
+    python catalog.py build catalog.bin title.basics.tsv.gz --ratings title.ratings.tsv.gz
+    python catalog.py search catalog.bin "the dark knigth" --year 2008
+
+  - .json / .jsonl: TMDB movie objects (id, title, release_date, poster_path,
+    overview, vote_average, vote_count, popularity, imdb_id, genres)
+  - .csv: the same fields as columns (e.g. the Kaggle TMDB dumps)
+  - .tsv: IMDb title.basics (movies only), rated from --ratings
+
+The file is memory-mapped, so its pages are shared by every worker process
+and only the vocabulary is held in Python objects. Records are numbered in
+popularity order, which makes the lowest id the natural tie-break.
+
+Layout (native byte order, sections 8-byte aligned):
+  header    MAGIC, record count, vocabulary size, (offset, length) per section
+  records   compact JSON per record, in TMDB search-result shape
+  titles    normalised title per record, years as uint16 (0 = unknown)
+  vocab     sorted title tokens, '\\n'-joined
+  postings  ascending record ids per token
+"""
+import os
+import io
+import csv
+import sys
+import gzip
+import json
+import mmap
+import time
+import bisect
+import struct
+import difflib
+import argparse
+import threading
+from array import array
+from caches import normalize_title
+import metrics
+
+MAGIC = b'MGCAT001'
+SECTIONS = ['records', 'record_offsets', 'titles', 'title_offsets', 'years', 'vocab', 'posting_offsets', 'postings']
+HEADER = struct.Struct('<8sII' + 'QQ' * len(SECTIONS))
+
+# A fuzzy match has to be at least this similar (difflib ratio, year adjusted) to be used
+MIN_SCORE = float(os.getenv("CATALOG_MIN_SCORE", 0.85))
+# Candidates scored per lookup, most popular first
+MAX_CANDIDATES = 500
+# Tokens shorter than this must match exactly (one edit turns 'up' into 'us')
+FUZZY_MIN_LENGTH = 4
+
+RECORD_FIELDS = ['id', 'title', 'release_date', 'poster_path', 'overview', 'vote_average', 'imdb_id']
+
+
+def _year(value):
+    try:
+        year = int(str(value)[:4])
+    except (TypeError, ValueError):
+        return 0
+    return year if 1800 < year < 3000 else 0
+
+def _without_article(title):
+    # 'the dark knight' and 'dark knight' name the same film
+    for article in ('the ', 'a ', 'an '):
+        if title.startswith(article) and len(title) > len(article):
+            return title[len(article):]
+    return title
+
+def _within_one_edit(a, b):
+    # Levenshtein distance <= 1, counting an adjacent swap as one edit
+    if a == b:
+        return True
+    la, lb = len(a), len(b)
+    if abs(la - lb) > 1:
+        return False
+    i = 0
+    while i < min(la, lb) and a[i] == b[i]:
+        i += 1
+    if la == lb:
+        return a[i + 1:] == b[i + 1:] or (a[i + 1:i + 2] == b[i:i + 1] and a[i:i + 1] == b[i + 1:i + 2] and a[i + 2:] == b[i + 2:])
+    return a[i + 1:] == b[i:] if la > lb else a[i:] == b[i + 1:]
+
+
+class MovieCatalog:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, vocab_size, *bounds = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"Not a movie catalog file: {path}")
+        view = memoryview(self._mm)
+        sections = {name: view[bounds[2 * i]:bounds[2 * i] + bounds[2 * i + 1]] for i, name in enumerate(SECTIONS)}
+        self._records = sections['records']
+        self._record_offsets = sections['record_offsets'].cast('Q')
+        self._titles = sections['titles']
+        self._title_offsets = sections['title_offsets'].cast('Q')
+        self._years = sections['years'].cast('H')
+        self._posting_offsets = sections['posting_offsets'].cast('Q')
+        self._postings = sections['postings'].cast('I')
+        self.vocab = bytes(sections['vocab']).decode('ascii').split('\n') if vocab_size else []
+        self._reversed = None # (sorted reversed tokens, vocab index), built on the first fuzzy lookup
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        return json.loads(bytes(self._records[self._record_offsets[i]:self._record_offsets[i + 1]]))
+
+    def title(self, i):
+        return str(self._titles[self._title_offsets[i]:self._title_offsets[i + 1]], 'ascii')
+
+    def _postings_of(self, index):
+        return self._postings[self._posting_offsets[index]:self._posting_offsets[index + 1]]
+
+    def _token_index(self, token):
+        i = bisect.bisect_left(self.vocab, token)
+        return i if i < len(self.vocab) and self.vocab[i] == token else None
+
+    def _near_tokens(self, token):
+        # Vocabulary indexes within one edit of token. One edit leaves either the first
+        # or the last (len - 1) // 2 characters intact, so both ends are range-scanned.
+        if len(token) < FUZZY_MIN_LENGTH:
+            index = self._token_index(token)
+            return [] if index is None else [index]
+        if self._reversed is None:
+            with self._lock:
+                if self._reversed is None:
+                    self._reversed = sorted((t[::-1], i) for i, t in enumerate(self.vocab))
+        k = (len(token) - 1) // 2
+        found = set()
+        prefix = token[:k]
+        for i in range(bisect.bisect_left(self.vocab, prefix), len(self.vocab)):
+            other = self.vocab[i]
+            if not other.startswith(prefix):
+                break
+            if _within_one_edit(token, other):
+                found.add(i)
+        suffix = token[::-1][:k]
+        for j in range(bisect.bisect_left(self._reversed, (suffix,)), len(self._reversed)):
+            other, i = self._reversed[j]
+            if not other.startswith(suffix):
+                break
+            if _within_one_edit(token, self.vocab[i]):
+                found.add(i)
+        return sorted(found)
+
+    def _candidates(self, tokens, fuzzy):
+        # Record ids containing every token (or a near token), most popular first
+        lists = []
+        for token in set(tokens):
+            indexes = self._near_tokens(token) if fuzzy else [self._token_index(token)]
+            postings = [self._postings_of(i) for i in indexes if i is not None]
+            if not postings:
+                return []
+            lists.append(postings[0] if len(postings) == 1 else sorted({doc for p in postings for doc in p}))
+        lists.sort(key=len)
+        # Walk the shortest list, binary-searching the others
+        found = []
+        for doc in lists[0]:
+            if all(_contains(other, doc) for other in lists[1:]):
+                found.append(doc)
+                if len(found) >= MAX_CANDIDATES:
+                    break
+        return found
+
+    def _score(self, query, year, i):
+        title = _without_article(self.title(i))
+        score = 1.0 if title == query else difflib.SequenceMatcher(None, query, title).ratio()
+        found_year = self._years[i]
+        if year and found_year and found_year != year:
+            # A release-date year can be off by one between sources; anything more is another film
+            score -= 0.05 if abs(found_year - year) == 1 else 0.2
+        return score
+
+    def search(self, title, year=None):
+        """Best matching record for a title (TMDB search-result shape), or None."""
+        query = normalize_title(title)
+        tokens = query.split()
+        if not tokens:
+            return None
+        year = _year(year)
+        core = _without_article(query)
+        for kind, fuzzy in (('exact', False), ('fuzzy', True)):
+            best, best_score = None, MIN_SCORE
+            for i in self._candidates(core.split(), fuzzy):
+                score = self._score(core, year, i)
+                if score > best_score:
+                    best, best_score = i, score
+                    if score >= 1.0:
+                        break # exact title (and year): nothing more popular can beat it
+            if best is not None:
+                metrics.catalog_lookups.inc(result=kind)
+                return self.record(best)
+        metrics.catalog_lookups.inc(result='miss')
+        return None
+
+    def close(self):
+        for name in ('_records', '_record_offsets', '_titles', '_title_offsets', '_years', '_posting_offsets', '_postings'):
+            getattr(self, name).release()
+        self._mm.close()
+
+
+def _contains(postings, doc):
+    i = bisect.bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+def open_catalog(path):
+    # The catalog is optional: without the file every lookup goes to the network
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        catalog = MovieCatalog(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"DEBUG: Movie catalog {path} unusable: {e}")
+        return None
+    print(f"DEBUG: Movie catalog loaded ({len(catalog)} titles, {len(catalog.vocab)} tokens)")
+    return catalog
+
+
+# --- Building ---
+def _open_text(path):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _genres(value):
+    # ['Drama', 'Romance'] from a list of names or {'name': ...} objects, a JSON
+    # string of either (Kaggle CSVs), or 'Drama,Romance' / 'Drama|Romance'
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            value = value.replace('|', ',').split(',')
+    if not isinstance(value, list):
+        return None
+    names = [g.get('name') if isinstance(g, dict) else g for g in value]
+    return [n.strip() for n in names if isinstance(n, str) and n.strip() and n != '\\N'] or None
+
+def _tmdb_rows(path):
+    base = path[:-3] if path.endswith('.gz') else path
+    with _open_text(path) as f:
+        if base.endswith('.csv'):
+            rows = csv.DictReader(f)
+        elif base.endswith('.jsonl'):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = json.load(f)
+            rows = rows.get('results', []) if isinstance(rows, dict) else rows
+        for row in rows:
+            title = row.get('title') or row.get('original_title')
+            if not title or row.get('adult') in (True, 'True', 'true'):
+                continue
+            record = {field: row.get(field) or None for field in RECORD_FIELDS}
+            record['title'] = title
+            record['vote_average'] = _number(record['vote_average'])
+            record['genres'] = _genres(row.get('genres'))
+            try:
+                record['id'] = int(record['id'])
+            except (TypeError, ValueError):
+                pass
+            yield record, _number(row.get('popularity')) or _number(row.get('vote_count')) or 0.0
+
+def _imdb_ratings(path):
+    ratings = {}
+    if path:
+        with _open_text(path) as f:
+            for row in csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                ratings[row['tconst']] = (_number(row['averageRating']), _number(row['numVotes']) or 0.0)
+    return ratings
+
+def _imdb_rows(path, ratings):
+    with _open_text(path) as f:
+        for row in csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if row.get('titleType') not in ('movie', 'tvMovie') or row.get('isAdult') == '1':
+                continue
+            rating, votes = ratings.get(row['tconst'], (None, 0.0))
+            year = row.get('startYear')
+            yield {
+                'id': row['tconst'],
+                'title': row['primaryTitle'],
+                'release_date': year if year and year != '\\N' else None,
+                'vote_average': rating,
+                'imdb_id': row['tconst'],
+                'genres': _genres(row.get('genres')),
+            }, votes
+
+def _align(out):
+    out.write(b'\0' * (-out.tell() % 8))
+
+def build(path, sources, ratings=None):
+    imdb_ratings = _imdb_ratings(ratings)
+    records, seen = [], set()
+    for source in sources:
+        base = source[:-3] if source.endswith('.gz') else source
+        rows = _imdb_rows(source, imdb_ratings) if base.endswith('.tsv') else _tmdb_rows(source)
+        for record, popularity in rows:
+            if record['id'] in seen:
+                continue
+            seen.add(record['id'])
+            records.append((-popularity, record))
+    records.sort(key=lambda item: item[0]) # stable: source order breaks popularity ties
+
+    blobs, titles, years, postings = [], [], array('H'), {}
+    for i, (_, record) in enumerate(records):
+        record = {k: v for k, v in record.items() if v is not None}
+        blobs.append(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+        title = normalize_title(record['title'])
+        titles.append(title.encode('ascii'))
+        years.append(_year(record.get('release_date')))
+        for token in set(title.split()):
+            postings.setdefault(token, array('I')).append(i)
+    vocab = sorted(postings)
+
+    def offsets(parts):
+        result, total = array('Q', [0]), 0
+        for part in parts:
+            total += len(part)
+            result.append(total)
+        return result
+
+    posting_offsets, total = array('Q', [0]), 0
+    for token in vocab:
+        total += len(postings[token])
+        posting_offsets.append(total)
+    sections = {
+        'records': blobs,
+        'record_offsets': [offsets(blobs).tobytes()],
+        'titles': titles,
+        'title_offsets': [offsets(titles).tobytes()],
+        'years': [years.tobytes()],
+        'vocab': ['\n'.join(vocab).encode('ascii')],
+        'posting_offsets': [posting_offsets.tobytes()],
+        'postings': [postings[token].tobytes() for token in vocab],
+    }
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(b'\0' * HEADER.size)
+        bounds = []
+        for name in SECTIONS:
+            _align(out)
+            start = out.tell()
+            for part in sections[name]:
+                out.write(part)
+            bounds.extend([start, out.tell() - start])
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, len(records), len(vocab), *bounds))
+    os.replace(tmp_path, path)
+    return len(records), len(vocab)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query the offline movie catalog')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_cmd = commands.add_parser('build', help='ingest dataset dumps into a catalog file')
+    build_cmd.add_argument('catalog')
+    build_cmd.add_argument('sources', nargs='+', help='.json/.jsonl/.csv TMDB dumps or IMDb title.basics .tsv (optionally .gz)')
+    build_cmd.add_argument('--ratings', help='IMDb title.ratings.tsv(.gz) for title.basics sources')
+    search_cmd = commands.add_parser('search', help='look a title up')
+    search_cmd.add_argument('catalog')
+    search_cmd.add_argument('title')
+    search_cmd.add_argument('--year', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        count, vocab = build(args.catalog, args.sources, args.ratings)
+        print(f"Wrote {count} titles ({vocab} tokens) to {args.catalog} in {time.perf_counter() - start:.1f}s "
+              f"({os.path.getsize(args.catalog) / 1e6:.1f} MB)")
+    else:
+        catalog = MovieCatalog(args.catalog)
+        start = time.perf_counter()
+        result = catalog.search(args.title, args.year)
+        print(json.dumps(result, indent=2))
+        print(f"{(time.perf_counter() - start) * 1000:.2f} ms", file=sys.stderr)
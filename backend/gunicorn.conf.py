@@ -0,0 +1,7 @@
+# Read by gunicorn when it is started from this directory (see setup_movieguru_server.sh),
+# for both app:app and asgi:app.
+
+def post_worker_init(worker):
+    # Migrations and background job workers, once per worker process
+    import app
+    app.startup()
@@ -0,0 +1,136 @@
+import asyncio
+import time
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+# Statuses worth another attempt: rate limiting and transient upstream trouble
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DeadlineExceeded(requests.Timeout):
+    pass
+
+
+def deadline_in(seconds):
+    # Absolute deadline (time.monotonic based) to pass to UpstreamClient calls
+    return time.monotonic() + seconds
+
+
+class UpstreamClient:
+    """Pooled, time-bounded HTTP client for one upstream host.
+
+    Every call gets (connect, read) timeouts, up to `retries` extra attempts
+    on connection errors / RETRY_STATUSES with jittered exponential backoff,
+    and an overall `budget` in seconds. Callers can pass a tighter absolute
+    `deadline` (see deadline_in) shared across several calls.
+    """
+    def __init__(self, name, connect_timeout=3.05, read_timeout=10.0, retries=2,
+                 backoff=0.25, budget=15.0, pool_size=20):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget
+        self.session = requests.Session()
+        # Keep-alive connections are reused across requests and worker threads
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, deadline=None, **kwargs):
+        deadline = min(deadline or float('inf'), deadline_in(self.budget))
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"{self.name}: deadline exceeded before attempt {attempt + 1}")
+            timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+                metrics.observe_upstream(self.name, response.status_code, time.monotonic() - start)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                reason = f"HTTP {response.status_code}"
+                # Not handed back: release the connection (stream=True leaves it checked out)
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.observe_upstream(self.name, 'error', time.monotonic() - start)
+                if attempt >= self.retries:
+                    raise
+                reason = type(e).__name__
+
+            # Full-jitter exponential backoff, never sleeping past the deadline
+            delay = random.uniform(0, self.backoff * (2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                raise DeadlineExceeded(f"{self.name}: no budget left to retry after {reason}")
+            print(f"DEBUG: {self.name} attempt {attempt + 1} failed ({reason}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+class AsyncUpstreamClient:
+    """asyncio twin of UpstreamClient on a shared httpx.AsyncClient.
+
+    Same timeouts, retry statuses, jittered backoff, budget and deadline
+    semantics; the client must be created inside the running event loop.
+    """
+    def __init__(self, name, connect_timeout=3.05, read_timeout=10.0, retries=2,
+                 backoff=0.25, budget=15.0, pool_size=100):
+        import httpx # only needed for the ASGI serving mode (see asgi.py)
+        self._httpx = httpx
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+
+    async def request(self, method, url, deadline=None, **kwargs):
+        httpx = self._httpx
+        deadline = min(deadline or float('inf'), deadline_in(self.budget))
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"{self.name}: deadline exceeded before attempt {attempt + 1}")
+            timeout = httpx.Timeout(min(self.read_timeout, remaining), connect=min(self.connect_timeout, remaining), pool=remaining)
+            start = time.monotonic()
+            try:
+                response = await self.client.request(method, url, timeout=timeout, **kwargs)
+                metrics.observe_upstream(self.name, response.status_code, time.monotonic() - start)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                reason = f"HTTP {response.status_code}"
+                await response.aclose()
+            except httpx.TransportError as e: # connection errors and timeouts
+                metrics.observe_upstream(self.name, 'error', time.monotonic() - start)
+                if attempt >= self.retries:
+                    raise
+                reason = type(e).__name__
+
+            delay = random.uniform(0, self.backoff * (2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                raise DeadlineExceeded(f"{self.name}: no budget left to retry after {reason}")
+            print(f"DEBUG: {self.name} attempt {attempt + 1} failed ({reason}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
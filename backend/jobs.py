@@ -0,0 +1,158 @@
+"""
+In-process background jobs, so write endpoints can answer before slow work
+(upstream lookups, collection writes) is done.
+
+    job_queue = JobQueue(workers=2)
+
+    @job_queue.handler('history')
+    def write_history(doc_id, record): ...
+
+    job_queue.submit('history', {'doc_id': ..., 'record': ...})
+
+Failed jobs are retried with exponential backoff, up to max_attempts runs.
+With a `store` collection (JOB_QUEUE_PERSIST=1 in app.py) every job is also
+saved there until it completes. When a process starts, it claims and re-runs
+the jobs left behind by processes that have died. Handlers must therefore be
+idempotent: a job can run twice if its process dies after the work but
+before the job is removed.
+"""
+import os
+import time
+import uuid
+import queue
+import threading
+import metrics
+
+
+def _alive(pid):
+    if not isinstance(pid, int) or os.name == 'nt': # os.kill(pid, 0) is not a probe on Windows
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # exists, owned by someone else
+    return True
+
+
+class JobQueue:
+    def __init__(self, workers=2, store=None, max_attempts=3, backoff=1.0, inline=False):
+        self.handlers = {}
+        self.workers = workers
+        self.store = store
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.inline = inline # run jobs in the submitting thread (tests, debugging)
+        self._queue = queue.Queue()
+        self._pid = None # process the worker threads belong to
+        self._owner = None # this process's claim token on stored jobs
+        self._pending = 0 # submitted and not yet finished, including retries waiting to run
+        self._idle = threading.Condition()
+
+    def handler(self, kind):
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def start(self):
+        # Starts the workers on first use in each process (threads don't survive a fork)
+        with self._idle:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._owner = str(uuid.uuid4())
+            self._queue = queue.Queue()
+            self._pending = 0
+            for i in range(self.workers):
+                threading.Thread(target=self._work, daemon=True, name=f'jobs-{i}').start()
+        if self.store is not None and not self.inline:
+            self._recover()
+
+    def submit(self, kind, payload):
+        job = {'id': str(uuid.uuid4()), 'kind': kind, 'payload': payload, 'attempts': 0, 'created': time.time()}
+        if self.inline:
+            self._run(job, retry=False)
+            return job['id']
+        self.start()
+        if self.store is not None:
+            self.store.set_doc(job['id'], {**job, 'owner': self._owner, 'owner_pid': os.getpid()})
+        self._enqueue(job)
+        return job['id']
+
+    def _enqueue(self, job):
+        with self._idle:
+            self._pending += 1
+        self._queue.put(job)
+
+    def _recover(self):
+        # Claim stored jobs whose process is gone. A reused pid can't still be the old
+        # owner (this process is that pid), so only the token decides for our own pid.
+        mine = os.getpid()
+        for doc in list(self.store.stream()):
+            record = doc.peek()
+            owner, owner_pid = record.get('owner'), record.get('owner_pid')
+            if owner == self._owner or (owner_pid != mine and _alive(owner_pid)):
+                continue
+            # Atomic under the collection lock: of several new processes, only one wins
+            claimed = self.store.update_doc(doc.id, lambda current: {**current, 'owner': self._owner, 'owner_pid': mine}
+                                            if current.get('owner') == owner else current)
+            if claimed and claimed.get('owner') == self._owner:
+                print(f"DEBUG: Recovered {claimed['kind']} job {doc.id} from process {owner_pid}")
+                self._enqueue({k: claimed[k] for k in ('id', 'kind', 'payload', 'attempts', 'created')})
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                print(f"Job worker error: {e}")
+
+    def _run(self, job, retry=True):
+        kind = job['kind']
+        start = time.monotonic()
+        metrics.job_delay_seconds.observe(max(0.0, time.time() - job['created']), kind=kind)
+        try:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                raise LookupError(f"no handler for job kind {kind!r}")
+            handler(**job['payload'])
+            outcome = 'ok'
+        except Exception as e:
+            job['attempts'] += 1
+            if retry and job['attempts'] < self.max_attempts:
+                delay = self.backoff * 2 ** (job['attempts'] - 1)
+                print(f"DEBUG: {kind} job {job['id']} failed ({e}), retrying in {delay:.2f}s")
+                metrics.jobs.inc(kind=kind, outcome='retry')
+                timer = threading.Timer(delay, self._queue.put, [job])
+                timer.daemon = True
+                timer.start()
+                return
+            print(f"Job {kind} {job['id']} failed after {job['attempts']} attempts: {e}")
+            outcome = 'failed'
+        metrics.jobs.inc(kind=kind, outcome=outcome)
+        metrics.job_seconds.observe(time.monotonic() - start, kind=kind)
+        if not self.inline:
+            self._finish(job)
+
+    def _finish(self, job):
+        try:
+            if self.store is not None:
+                self.store.delete_doc(job['id'])
+        except Exception as e:
+            print(f"Could not remove finished job {job['id']}: {e}")
+        with self._idle:
+            self._pending -= 1
+            if self._pending <= 0:
+                self._idle.notify_all()
+
+    def pending(self):
+        with self._idle:
+            return self._pending
+
+    def drain(self, timeout=None):
+        # Wait until every submitted job has finished; False on timeout
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending <= 0, timeout)
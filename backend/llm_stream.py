@@ -0,0 +1,91 @@
+import json
+
+
+def iter_sse_data(lines):
+    # `data:` payloads from a Server-Sent Events line stream (comments/keep-alives skipped)
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if line.startswith('data:'):
+            yield line[5:].strip()
+
+
+def iter_chat_deltas(lines):
+    # Text chunks of an OpenAI/OpenRouter style streamed chat completion
+    for data in iter_sse_data(lines):
+        if data == '[DONE]':
+            return
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            continue
+        if chunk.get('error'):
+            raise RuntimeError(chunk['error'].get('message', 'stream error'))
+        for choice in chunk.get('choices', []):
+            text = (choice.get('delta') or {}).get('content') or (choice.get('message') or {}).get('content')
+            if text:
+                yield text
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class JsonArrayStream:
+    """Incrementally pulls complete objects out of a streamed JSON array.
+
+    feed() takes the next chunk of model output and returns the objects of
+    the top-level array that became complete. Anything before the opening
+    '[' (prose, ```json fences) is ignored.
+    """
+    def __init__(self):
+        self._buf = ''
+        self._pos = 0 # next character of _buf to scan
+        self._started = False
+        self.finished = False
+        self._depth = 0 # nesting depth inside the array
+        self._in_string = False
+        self._escape = False
+        self._obj_start = None
+
+    def feed(self, text):
+        if self.finished:
+            return []
+        self._buf += text
+        found = []
+        while self._pos < len(self._buf):
+            ch = self._buf[self._pos]
+            if not self._started:
+                if ch == '[':
+                    self._started = True
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if self._depth == 0 and ch == '{':
+                    self._obj_start = self._pos
+                self._depth += 1
+            elif ch in '}]':
+                if self._depth == 0:
+                    # End of the top-level array: ignore anything after it
+                    self.finished = True
+                    self._buf, self._pos = '', 0
+                    return found
+                self._depth -= 1
+                if self._depth == 0 and self._obj_start is not None:
+                    try:
+                        found.append(json.loads(self._buf[self._obj_start:self._pos + 1]))
+                    except ValueError:
+                        pass
+                    self._obj_start = None
+            self._pos += 1
+        if self._obj_start is None and self._started:
+            # Nothing pending: drop what's been scanned to keep the buffer small
+            self._buf, self._pos = self._buf[self._pos:], 0
+        return found
@@ -0,0 +1,800 @@
+import os
+import json
+import uuid
+import datetime
+import heapq
+import bisect
+import threading
+import time
+from itertools import islice
+from contextlib import contextmanager, ExitStack
+import metrics
+
+try:
+    import fcntl
+except ImportError: # Windows dev machines
+    fcntl = None
+    import msvcrt
+
+DATA_DIR = os.environ.get('MOVIEGURU_DATA_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+# Collections stored as lists of records carrying their own 'id' field.
+# Everything else (users) is a dict keyed by document id.
+LIST_COLLECTIONS = ['posts', 'search_history', 'comments']
+
+# Secondary equality indexes declared up front; more can be added at runtime
+# with LocalCollection.create_index(field).
+INDEXES = {
+    'posts': ['author'],
+    'search_history': ['email'],
+    'comments': ['post_id'],
+}
+
+# Fields kept in sorted order so order_by(field).limit(n) can walk the newest n
+# records directly instead of sorting the whole collection.
+SORTED_INDEXES = {
+    'posts': ['timestamp'],
+    'search_history': ['timestamp'],
+    'comments': ['timestamp'],
+}
+
+@contextmanager
+def file_lock(path):
+    # Exclusive advisory lock shared by every worker process
+    with open(path, 'a+') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# --- Local DB Implementation ---
+class LocalDocument:
+    # Created for every streamed record, so no per-instance __dict__
+    __slots__ = ('_data', 'id', 'exists', '_wrapper')
+
+    def __init__(self, data, doc_id, wrapper):
+        self._data = data
+        self.id = doc_id
+        self.exists = data is not None
+        self._wrapper = wrapper
+
+    def to_dict(self):
+        # Shallow copy so callers can't mutate the cached record in place
+        return dict(self._data) if self._data else {}
+
+    def peek(self):
+        # The stored record itself, no copy: read-only, for serialising responses.
+        # Writes always replace records, never mutate them, so it stays consistent.
+        return self._data or {}
+
+    @property
+    def reference(self):
+        return self
+
+    def get(self):
+        return self
+
+    def set(self, data):
+        self._wrapper.set_doc(self.id, data)
+
+    def update(self, data):
+        # Read-modify-write against the latest stored record while holding the
+        # collection lock. `data` is a dict of field changes, or a callable that
+        # receives the current record and returns one.
+        if not self.exists: return
+        self._data = self._wrapper.update_doc(self.id, lambda current: _merge(current, data))
+        self.exists = self._data is not None
+
+    def delete(self):
+        self._wrapper.delete_doc(self.id)
+
+class _ServerTimestamp:
+    # Firestore-style placeholder: a top-level field set to SERVER_TIMESTAMP is
+    # replaced with the time of the commit that writes it
+    def __repr__(self):
+        return 'SERVER_TIMESTAMP'
+
+SERVER_TIMESTAMP = _ServerTimestamp()
+
+def resolve_timestamps(ops):
+    now = None
+    for op in ops:
+        data = op.get('data')
+        if data and any(v is SERVER_TIMESTAMP for v in data.values()):
+            now = now or datetime.datetime.now().isoformat()
+            op['data'] = {k: now if v is SERVER_TIMESTAMP else v for k, v in data.items()}
+    return ops
+
+def _merge(current, data):
+    # Apply update() field changes (dict or callable) to a copy of a record
+    changes = data(current) if callable(data) else data
+    # Handle simple updates and ArrayUnion
+    for k, v in changes.items():
+        if isinstance(v, list) and hasattr(v, 'is_array_union'):
+            current[k] = list(current.get(k, [])) + list(v)
+        else:
+            current[k] = v
+    return current
+
+class JsonFileStorage:
+    """Whole-collection storage: every commit rewrites <name>.json."""
+    def __init__(self, name):
+        self.name = name
+        self.file_path = os.path.join(DATA_DIR, f'{name}.json')
+        self.lock_path = os.path.join(DATA_DIR, f'{name}.lock')
+        self._signature = None
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self, empty):
+        if not os.path.exists(self.file_path):
+            self.save(empty)
+            return empty
+        data = self._read_snapshot()
+        self._signature = self._stat_signature()
+        return data
+
+    def _read_snapshot(self):
+        # Writes go through os.replace, so a parse error means real corruption:
+        # fail loudly rather than carry on with (and later save) an empty collection
+        start = time.perf_counter()
+        with open(self.file_path, 'r') as f:
+            try:
+                data = json.load(f)
+            except ValueError as e:
+                raise ValueError(f"Corrupt collection file {self.file_path}: {e}")
+        metrics.db_load_seconds.observe(time.perf_counter() - start, collection=self.name, kind='snapshot')
+        return data
+
+    def changed(self):
+        # Another gunicorn worker may have rewritten the file
+        return self._stat_signature() != self._signature
+
+    def refresh(self, collection):
+        if self.changed():
+            collection._reset(self.load(collection._empty()))
+
+    def save(self, data):
+        start = time.perf_counter()
+        written = self._write_atomic(json.dumps(data, indent=4, default=str))
+        self._signature = self._stat_signature()
+        self._observe_write('snapshot', start, written)
+
+    def _observe_write(self, kind, start, written):
+        metrics.db_save_seconds.observe(time.perf_counter() - start, collection=self.name, kind=kind)
+        metrics.db_bytes_written.inc(written, collection=self.name, kind=kind)
+
+    def _write_atomic(self, text):
+        tmp_path = f'{self.file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            written = f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        return written
+
+    def commit(self, collection, ops):
+        self.save(collection.data)
+
+class WalStorage(JsonFileStorage):
+    """Snapshot (<name>.json) plus an append-only log (<name>.wal.jsonl).
+
+    Each commit appends one JSON line, so write cost scales with the size of
+    the change; a multi-op commit (batch) is a single 'batch' line, so a torn
+    append never replays half of it. Once the log passes COMPACT_BYTES it is folded into
+    a fresh snapshot on a background thread.
+    """
+    COMPACT_BYTES = int(os.environ.get('MOVIEGURU_WAL_COMPACT_BYTES', 1024 * 1024))
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.log_path = os.path.join(DATA_DIR, f'{name}.wal.jsonl')
+        self._offset = 0 # bytes of the log already applied to memory
+        self._compacting = False
+
+    def _log_size(self):
+        try:
+            return os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return 0
+
+    def _replay(self, collection, start):
+        began = time.perf_counter()
+        with open(self.log_path, 'rb') as f:
+            f.seek(start)
+            chunk = f.read()
+        # A torn trailing line (crash mid-append) is left for the next refresh
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            if line.strip():
+                record = json.loads(line)
+                for op in record['ops'] if record['op'] == 'batch' else [record]:
+                    collection._apply(op)
+        metrics.db_load_seconds.observe(time.perf_counter() - began, collection=self.name, kind='wal')
+        return start + end
+
+    def load(self, empty):
+        if os.path.exists(self.file_path):
+            empty = self._read_snapshot()
+        self._signature = self._stat_signature()
+        self._offset = 0
+        return empty
+
+    def changed(self):
+        return self._stat_signature() != self._signature or self._log_size() != self._offset
+
+    def refresh(self, collection):
+        if self._stat_signature() != self._signature:
+            # Snapshot replaced by a compaction: rebuild from scratch
+            collection._reset(self.load(collection._empty()))
+        if self._log_size() > self._offset:
+            self._offset = self._replay(collection, self._offset)
+
+    def commit(self, collection, ops):
+        start = time.perf_counter()
+        record = ops[0] if len(ops) == 1 else {'op': 'batch', 'ops': ops}
+        payload = (json.dumps(record, default=str) + '\n').encode('utf-8')
+        with open(self.log_path, 'ab') as f:
+            f.write(payload)
+        self._offset += len(payload)
+        self._observe_write('wal', start, len(payload))
+        if self._offset > self.COMPACT_BYTES and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self._compact, args=(collection,), daemon=True).start()
+
+    def _compact(self, collection):
+        try:
+            with collection._locked():
+                self.refresh(collection)
+                offset = self._offset
+                signature = self._signature
+                snapshot = json.dumps(collection.data, indent=4, default=str)
+            with collection._locked():
+                if self._stat_signature() != signature:
+                    return # another worker compacted in the meantime
+                # Apply what other workers appended since the snapshot was taken: it stays
+                # in the log, but memory must have it before the offset is rebased past it
+                self.refresh(collection)
+                start = time.perf_counter()
+                self._observe_write('compaction', start, self._write_atomic(snapshot))
+                # Keep whatever was appended while the snapshot was serialised
+                with open(self.log_path, 'rb') as f:
+                    f.seek(offset)
+                    tail = f.read()
+                tmp_path = f'{self.log_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(tail)
+                os.replace(tmp_path, self.log_path)
+                self._signature = self._stat_signature()
+                self._offset -= offset
+        except Exception as e:
+            print(f"WAL compaction failed for {self.file_path}: {e}")
+        finally:
+            self._compacting = False
+
+STORAGE_ENGINES = {'json': JsonFileStorage, 'wal': WalStorage}
+STORAGE_MODE = os.environ.get('MOVIEGURU_DB_STORAGE', 'json')
+
+class LocalCollection:
+    def __init__(self, name, storage=None):
+        self.name = name
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._version = 0 # bumped on every applied op or reload, see version()
+        self._storage = (storage or STORAGE_ENGINES[STORAGE_MODE])(name)
+        self._index_fields = list(INDEXES.get(name, []))
+        self._sorted_fields = list(SORTED_INDEXES.get(name, [])) if name in LIST_COLLECTIONS else []
+        with self._locked():
+            self._reset(self._storage.load(self._empty()))
+            self._storage.refresh(self)
+
+    def _empty(self):
+        return [] if self.name in LIST_COLLECTIONS else {}
+
+    # --- Indexes ---
+    def _reset(self, data):
+        # Replace the in-memory data wholesale and rebuild every index
+        self.data = data
+        self._version += 1
+        self._positions = {} # str(id) -> position, list collections only
+        if isinstance(data, list):
+            for i, x in enumerate(data):
+                # Duplicate ids in legacy data resolve to the first match, as before
+                self._positions.setdefault(str(x.get('id', '')), i)
+        self._indexes = {field: {} for field in self._index_fields} # field -> value -> {doc ids}
+        for doc_id, record in self._items():
+            self._index_add(doc_id, record, sorted_too=False)
+        self._sorted = {} # field -> ascending list of (value, doc id)
+        for field in self._sorted_fields:
+            try:
+                self._sorted[field] = sorted((record.get(field, ''), doc_id) for doc_id, record in self._items())
+            except TypeError:
+                print(f"DEBUG: {self.name}.{field} has mixed value types, not keeping it sorted")
+
+    def _items(self):
+        if isinstance(self.data, dict):
+            return self.data.items()
+        return ((str(x.get('id', '')), x) for x in self.data)
+
+    def _index_add(self, doc_id, record, sorted_too=True):
+        for field, index in self._indexes.items():
+            value = record.get(field)
+            if _hashable(value):
+                index.setdefault(value, set()).add(doc_id)
+        if sorted_too:
+            for field, keys in list(self._sorted.items()):
+                try:
+                    bisect.insort(keys, (record.get(field, ''), doc_id))
+                except TypeError:
+                    print(f"DEBUG: {self.name}.{field} has mixed value types, not keeping it sorted")
+                    del self._sorted[field]
+
+    def _index_remove(self, doc_id, record):
+        for field, index in self._indexes.items():
+            value = record.get(field)
+            if _hashable(value):
+                ids = index.get(value)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del index[value]
+        for field, keys in self._sorted.items():
+            key = (record.get(field, ''), doc_id)
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+    def create_index(self, field):
+        with self._lock:
+            if field not in self._index_fields:
+                self._index_fields.append(field)
+                self._reset(self.data)
+
+    def _lookup(self, field, value):
+        # Doc ids whose field equals value, or None when the field isn't indexed
+        index = self._indexes.get(field)
+        if index is None or not _hashable(value):
+            return None
+        return index.get(value, ())
+
+    def _refresh(self):
+        # Cheap stat check first; only take the file lock when there is something to reload
+        if self._storage.changed():
+            with metrics.timed('db'), self._locked():
+                self._storage.refresh(self)
+
+    @contextmanager
+    def _locked(self):
+        # Thread lock for this process plus the cross-process file lock.
+        # Re-entrant so nested commits (e.g. update_doc -> _commit) don't deadlock.
+        with self._lock:
+            if self._lock_depth:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with file_lock(self._storage.lock_path):
+                self._lock_depth = 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth = 0
+
+    def version(self):
+        # Changes whenever the collection's content may have (including other
+        # workers' writes); only comparable within this process
+        self._refresh()
+        return self._version
+
+    def _get(self, doc_id):
+        if isinstance(self.data, dict):
+            return self.data.get(doc_id)
+        pos = self._positions.get(str(doc_id))
+        return self.data[pos] if pos is not None else None
+
+    def _apply(self, op):
+        # Ops are the unit of both in-memory mutation and WAL replay
+        self._version += 1
+        doc_id = op['id']
+        key = str(doc_id)
+        existing = self._get(doc_id)
+        if op.get('replace') is not None and existing is not None:
+            # Nothing to take over, this id is already stored: update it and drop the other
+            self._apply({'op': 'set', 'id': doc_id, 'data': op['data']})
+            self._apply({'op': 'delete', 'id': op['replace']})
+            return
+        if existing is not None:
+            self._index_remove(key, existing)
+        if op['op'] == 'set':
+            data = op['data']
+            # set(..., replace=old) stores the record in place of `old`, see WriteBatch.set
+            replaced = self._get(op['replace']) if op.get('replace') is not None else None
+            if replaced is not None:
+                self._index_remove(str(op['replace']), replaced)
+            if isinstance(self.data, dict):
+                if replaced is not None:
+                    del self.data[op['replace']]
+                self.data[doc_id] = data
+            else:
+                # Create new or replace
+                data['id'] = doc_id
+                pos = self._positions.get(key)
+                if pos is None and replaced is not None:
+                    pos = self._positions.pop(str(op['replace']))
+                    self._positions[key] = pos
+                if pos is not None:
+                    self.data[pos] = data
+                else:
+                    self._positions[key] = len(self.data)
+                    self.data.append(data)
+            self._index_add(key, data)
+        elif op['op'] == 'delete':
+            if isinstance(self.data, dict):
+                self.data.pop(doc_id, None)
+            else:
+                pos = self._positions.pop(key, None)
+                if pos is not None:
+                    del self.data[pos]
+                    # Shift the positions of everything after the removed record
+                    for i in range(pos, len(self.data)):
+                        self._positions[str(self.data[i].get('id', ''))] = i
+
+    def _commit(self, ops):
+        # Refresh and write under the file lock so no other worker's commit is lost
+        with metrics.timed('db'), self._locked():
+            self._refresh()
+            for op in resolve_timestamps(ops):
+                self._apply(op)
+            self._storage.commit(self, ops)
+
+    def document(self, doc_id):
+        with self._lock:
+            self._refresh()
+            return LocalDocument(self._get(doc_id), doc_id, self)
+
+    def set_doc(self, doc_id, data):
+        self._commit([{'op': 'set', 'id': doc_id, 'data': data}])
+
+    def delete_doc(self, doc_id):
+        self._commit([{'op': 'delete', 'id': doc_id}])
+
+    def update_doc(self, doc_id, fn):
+        # Atomic read-modify-write: fn gets a copy of the latest record and
+        # returns the new one. Returns None if the document no longer exists.
+        with self._locked():
+            self._refresh()
+            current = self._get(doc_id)
+            if current is None:
+                return None
+            new = fn(dict(current))
+            self._commit([{'op': 'set', 'id': doc_id, 'data': new}])
+            return new
+
+    def add(self, data):
+        if self.name not in LIST_COLLECTIONS:
+            return None, None
+        doc_id = str(uuid.uuid4())
+        data['id'] = doc_id
+        self._commit([{'op': 'set', 'id': doc_id, 'data': data}])
+        return datetime.datetime.now(), self.document(doc_id)
+
+    # Query methods
+    def _view(self):
+        with self._lock:
+            self._refresh()
+            return QueryView(self)
+
+    def where(self, field, op, value):
+        # Return a filtered View of collection
+        return self._view().where(field, op, value)
+
+    def order_by(self, field, direction='desc'):
+        return self._view().order_by(field, direction)
+
+    def stream(self):
+        return self._view().stream()
+
+class QueryView:
+    # Queries are composed lazily and evaluated against the collection in stream()
+    __slots__ = ('collection', 'filters', 'order', '_limit', 'cursor')
+
+    def __init__(self, collection, filters=(), order=None, limit=None, cursor=None):
+        self.collection = collection # owning LocalCollection, shared by yielded documents
+        self.filters = filters
+        self.order = order
+        self._limit = limit
+        self.cursor = cursor # (order value, doc id) of the last record already seen
+
+    def _derive(self, **changes):
+        state = {'filters': self.filters, 'order': self.order, 'limit': self._limit, 'cursor': self.cursor}
+        state.update(changes)
+        return QueryView(self.collection, **state)
+
+    def where(self, field, op, value):
+        # Only support == for now as per app usage
+        if op != '==':
+            raise NotImplementedError(f"Unsupported query operator: {op}")
+        return self._derive(filters=self.filters + ((field, value),))
+
+    def order_by(self, field, direction='desc'):
+        # Only lists can be ordered
+        if isinstance(self.collection.data, list):
+            return self._derive(order=(field, direction))
+        return self
+
+    def limit(self, limit):
+        if isinstance(self.collection.data, list):
+            return self._derive(limit=limit)
+        return self
+
+    def start_after(self, cursor):
+        # Resume an ordered query after a record: cursor is a LocalDocument from a
+        # previous page or an (order value, doc id) pair. Call after order_by().
+        if not self.order:
+            raise ValueError("start_after() requires order_by()")
+        if isinstance(cursor, LocalDocument):
+            cursor = (cursor.to_dict().get(self.order[0], ''), cursor.id)
+        value, doc_id = cursor
+        return self._derive(cursor=(value, str(doc_id)))
+
+    def _best_index(self):
+        # (position in filters, matching doc ids) of the most selective indexed
+        # equality filter, or None when no filter is indexed
+        best = None
+        for i, (field, value) in enumerate(self.filters):
+            ids = self.collection._lookup(field, value)
+            if ids is not None and (best is None or len(ids) < len(best[1])):
+                best = (i, ids)
+        return best
+
+    def _results(self):
+        coll = self.collection
+        with coll._lock:
+            filters = list(self.filters)
+            best = self._best_index()
+            if best is not None:
+                del filters[best[0]]
+            if best is None:
+                items = coll._items()
+            elif self.order:
+                items = ((doc_id, coll._get(doc_id)) for doc_id in best[1])
+            else:
+                # Keep stored (insertion) order, same as a full scan
+                ids = sorted(best[1], key=coll._positions.__getitem__) if isinstance(coll.data, list) else best[1]
+                items = ((doc_id, coll._get(doc_id)) for doc_id in ids)
+            matches = ((doc_id, record) for doc_id, record in items
+                       if all(record.get(field) == value for field, value in filters))
+            if not self.order:
+                return list(islice(matches, self._limit))
+
+            field, direction = self.order
+            desc = direction == 'desc'
+            keys = coll._sorted.get(field)
+            within = None # when set, the sorted walk only keeps these doc ids
+            if keys is not None and best is not None and self._limit is not None:
+                # Walking the sorted index visits ~limit * N / len(ids) keys, ranking the
+                # index hits costs ~len(ids): walk when the hits are common enough
+                if self._limit * len(keys) < len(best[1]) ** 2:
+                    within, best = best[1], None
+            if keys is not None and best is None:
+                # Walk the sorted index from the newest end (or just past the cursor),
+                # stopping after limit matches
+                if desc:
+                    hi = len(keys) if self.cursor is None else bisect.bisect_left(keys, self.cursor)
+                    walk = (keys[i] for i in range(hi - 1, -1, -1))
+                else:
+                    lo = 0 if self.cursor is None else bisect.bisect_right(keys, self.cursor)
+                    walk = (keys[i] for i in range(lo, len(keys)))
+                results = []
+                for _, doc_id in walk:
+                    if within is not None and doc_id not in within:
+                        continue
+                    record = coll._get(doc_id)
+                    if all(record.get(f) == v for f, v in filters):
+                        results.append((doc_id, record))
+                        if self._limit is not None and len(results) >= self._limit:
+                            break
+                return results
+
+            # No usable sorted index: top-k selection when limited, full sort otherwise
+            sort_key = lambda item: (item[1].get(field, ''), item[0])
+            if self.cursor is not None:
+                after = (lambda item: sort_key(item) < self.cursor) if desc else (lambda item: sort_key(item) > self.cursor)
+                matches = filter(after, matches)
+            if self._limit is not None:
+                pick = heapq.nlargest if desc else heapq.nsmallest
+                return pick(self._limit, matches, key=sort_key)
+            return sorted(matches, key=sort_key, reverse=desc)
+
+    def stream(self):
+        # Yield LocalDocuments
+        with metrics.timed('db'):
+            results = self._results()
+        for doc_id, record in results:
+            yield LocalDocument(record, record.get('id', doc_id) if isinstance(self.collection.data, list) else doc_id, self.collection)
+
+def _hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+class WriteBatch:
+    """Firestore-style write batch.
+
+    set/update/delete only queue changes; commit() applies them with one
+    durable flush per collection touched (one snapshot rewrite, or one WAL
+    line). Collections are locked in name order for the whole commit.
+    """
+    def __init__(self):
+        self._writes = [] # (collection, doc_id, kind, data)
+
+    def set(self, ref, data, replace=None):
+        # replace=other_ref deletes that document in the same write and, in list
+        # collections, stores this one in its slot: nothing after it has to move,
+        # so a capped collection can recycle its oldest record like a ring buffer
+        if replace is not None:
+            self._writes.append((ref._wrapper, ref.id, 'replace', (replace.id, data)))
+        else:
+            self._writes.append((ref._wrapper, ref.id, 'set', data))
+        return self
+
+    def update(self, ref, data):
+        # Same semantics as LocalDocument.update: a missing document is skipped
+        self._writes.append((ref._wrapper, ref.id, 'update', data))
+        return self
+
+    def delete(self, ref):
+        self._writes.append((ref._wrapper, ref.id, 'delete', None))
+        return self
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        by_collection = {}
+        for coll, doc_id, kind, data in writes:
+            by_collection.setdefault(coll.name, (coll, []))[1].append((doc_id, kind, data))
+        with ExitStack() as stack:
+            for name in sorted(by_collection):
+                stack.enter_context(by_collection[name][0]._locked())
+            for coll, coll_writes in by_collection.values():
+                coll._refresh()
+                coll._commit(self._ops(coll, coll_writes))
+
+    @staticmethod
+    def _ops(coll, writes):
+        # Fold the queued writes into one op per document (its final state)
+        pending = {} # doc_id -> record, None once deleted
+        replaces = {} # doc_id -> id of the document it takes the place of
+        for doc_id, kind, data in writes:
+            if kind == 'replace':
+                replaces[doc_id], data = data
+            elif kind == 'update':
+                current = pending[doc_id] if doc_id in pending else coll._get(doc_id)
+                if current is None:
+                    continue
+                data = _merge(dict(current), data)
+            pending[doc_id] = None if kind == 'delete' else data
+        ops = []
+        for doc_id, record in pending.items():
+            if record is None:
+                ops.append({'op': 'delete', 'id': doc_id})
+            elif doc_id in replaces:
+                ops.append({'op': 'set', 'id': doc_id, 'data': record, 'replace': replaces[doc_id]})
+            else:
+                ops.append({'op': 'set', 'id': doc_id, 'data': record})
+        return ops
+
+class Transaction(WriteBatch):
+    """Read-modify-write across documents, used as a context manager:
+
+        with db.transaction() as txn:
+            doc = txn.get(ref)
+            txn.update(ref, {...})
+
+    get() locks the document's collection (thread and file lock) until the
+    block ends, so nothing else can write in between; queued writes commit
+    on a clean exit and are dropped if the block raises. Pessimistic locking
+    instead of Firestore's optimistic retries, so every lock holder must take
+    collections in the same order: by name, as WriteBatch.commit does. A
+    transaction that would lock a collection sorting before one it already
+    holds (by get(), or at commit for a collection it only writes) raises
+    instead. lock() takes several collections up front, in order.
+    """
+    def __init__(self):
+        super().__init__()
+        self._stack = ExitStack()
+        self._held = set()
+
+    def lock(self, *collections):
+        for coll in sorted(collections, key=lambda c: c.name):
+            self._lock(coll)
+        return self
+
+    def _lock(self, coll):
+        if coll.name in self._held:
+            return
+        if self._held and coll.name < max(self._held):
+            # Another holder taking them in name order would deadlock against us (ABBA)
+            raise RuntimeError(f"transaction locks {coll.name!r} after {max(self._held)!r}; "
+                               f"lock collections in name order (Transaction.lock)")
+        self._stack.enter_context(coll._locked())
+        self._held.add(coll.name)
+
+    def get(self, ref):
+        coll = ref._wrapper
+        self._lock(coll)
+        coll._refresh()
+        return LocalDocument(coll._get(ref.id), ref.id, coll)
+
+    def commit(self):
+        # Collections only written to are locked here, after everything get() took
+        for coll, _, _, _ in self._writes:
+            self._lock(coll)
+        super().commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self._writes = []
+        finally:
+            self._stack.close()
+            self._held.clear()
+
+# One shared collection object per name for the life of the process
+_collections = {}
+_collections_lock = threading.Lock()
+
+class LocalDB:
+    def collection(self, name):
+        coll = _collections.get(name)
+        if coll is None:
+            with _collections_lock:
+                coll = _collections.get(name)
+                if coll is None:
+                    coll = _collections[name] = LocalCollection(name)
+        return coll
+
+    def batch(self):
+        return WriteBatch()
+
+    def transaction(self):
+        return Transaction()
+
+# Mock Firestore helpers
+class MockFirestore:
+    def client(self): return LocalDB()
+    class Query:
+        ASCENDING = 'asc'
+        DESCENDING = 'desc'
+    class ArrayUnion(list):
+        def __init__(self, iterable):
+            super().__init__(iterable)
+            self.is_array_union = True
+    SERVER_TIMESTAMP = SERVER_TIMESTAMP
@@ -0,0 +1,263 @@
+"""
+Offline recommender for /api/recommend: latent semantic indexing (TF-IDF +
+truncated SVD) over the titles, genres and overviews in the movie catalog
+(catalog.py). Runs on CPU with no network, so recommendations keep coming
+when OpenRouter is slow or down.
+
+    python local_recommender.py build catalog.bin
+    python local_recommender.py query catalog.bin "need a good cry" --favorite "Titanic"
+
+The model is two files next to the catalog: <catalog>.lsi.npz (vocabulary,
+IDF weights and the term -> concept projection) and <catalog>.lsi.npy (one
+unit-length concept vector per catalog record, memory-mapped). A query is
+embedded the same way as a document and scored against every record with one
+matrix-vector product. The user's favorites are embedded as well and blended
+in as a preference vector.
+
+numpy is optional: without it (or without a built model) app.py simply skips
+this step.
+"""
+import os
+import sys
+import math
+import time
+import argparse
+from collections import Counter
+from caches import normalize_title
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Concept dimensions kept from the SVD
+DIMENSIONS = 96
+# Terms in fewer documents than this are dropped, as are terms in more than MAX_DF of them
+MIN_DF = 2
+MAX_DF = 0.4
+MAX_TERMS = 60000
+# Share of the query vector given to the user's favorites
+FAVORITES_WEIGHT = float(os.getenv("RECOMMENDER_FAVORITES_WEIGHT", 0.3))
+# Small boost for well-known films (records are numbered in popularity order)
+POPULARITY_WEIGHT = float(os.getenv("RECOMMENDER_POPULARITY_WEIGHT", 0.05))
+
+STOPWORDS = set("""
+a about after again against all also an and any are as at be because been before being between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself
+him himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only
+or other our ours out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why
+will with would you your yours one two new life film movie story must becomes finds
+""".split())
+
+# Moods rarely share words with plot summaries; these add the genre and theme
+# words a mood usually calls for.
+MOOD_TERMS = {
+    'sad': 'drama grief loss tearjerker', 'cry': 'drama grief loss tearjerker', 'depressed': 'drama hope',
+    'heartbroken': 'romance drama breakup', 'lonely': 'friendship connection drama', 'happy': 'comedy fun friendship',
+    'cheerful': 'comedy fun family', 'funny': 'comedy', 'laugh': 'comedy', 'silly': 'comedy parody',
+    'romantic': 'romance love', 'love': 'romance love', 'scared': 'horror', 'scary': 'horror supernatural',
+    'spooky': 'horror supernatural', 'excited': 'action adventure', 'adventurous': 'adventure journey quest',
+    'bored': 'action adventure thriller', 'thrill': 'thriller suspense', 'tense': 'thriller suspense',
+    'angry': 'revenge action crime', 'nostalgic': 'family childhood classic', 'cozy': 'family animation comedy',
+    'inspired': 'biography sport triumph', 'motivated': 'sport biography triumph', 'curious': 'mystery documentary',
+    'thoughtful': 'drama philosophical', 'mindbending': 'science fiction mystery', 'stressed': 'comedy animation family',
+    'anxious': 'comedy animation family', 'relaxed': 'comedy romance', 'epic': 'epic war history adventure',
+    'space': 'science fiction space', 'dark': 'crime noir thriller', 'magical': 'fantasy magic animation',
+}
+
+
+def _stem(token):
+    # Plural 's' only ('spaceships' -> 'spaceship'), enough to join most query and plot words
+    return token[:-1] if len(token) > 4 and token.endswith('s') and not token.endswith(('ss', 'us', 'is')) else token
+
+def tokenize(text):
+    return [_stem(t) for t in normalize_title(text).split() if len(t) > 2 and t not in STOPWORDS and not t.isdigit()]
+
+def record_text(record):
+    # Genres count double: they are the words moods map onto
+    genres = ' '.join(record.get('genres') or [])
+    return ' '.join([record.get('title') or '', genres, genres, record.get('overview') or ''])
+
+def expand_mood(mood):
+    tokens = tokenize(mood)
+    extra = []
+    for token in tokens:
+        extra.extend(tokenize(MOOD_TERMS.get(token, '')))
+    return tokens + extra
+
+
+class LocalRecommender:
+    def __init__(self, path, catalog):
+        model = np.load(path + '.npz')
+        self.catalog = catalog
+        self.vocab = {term: i for i, term in enumerate(model['vocab'].tolist())}
+        self.idf = model['idf']
+        self.terms = model['terms'] # (terms, DIMENSIONS)
+        self.docs = np.load(path + '.npy', mmap_mode='r') # (records, DIMENSIONS), unit rows
+        if len(self.docs) != len(catalog):
+            raise ValueError(f"model has {len(self.docs)} records, catalog has {len(catalog)}: rebuild it")
+        self.prior = np.linspace(POPULARITY_WEIGHT, 0, len(self.docs), dtype=np.float32)
+
+    def embed(self, tokens):
+        # Unit concept vector for a bag of tokens, or None if none are known
+        counts = Counter(t for t in tokens if t in self.vocab)
+        if not counts:
+            return None
+        ids = np.fromiter((self.vocab[t] for t in counts), dtype=np.int64, count=len(counts))
+        weights = np.fromiter(((1 + math.log(c)) for c in counts.values()), dtype=np.float32, count=len(counts)) * self.idf[ids]
+        vector = weights @ self.terms[ids]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def recommend(self, mood, favorites=(), k=5):
+        """[(record, reason)] for a mood, leaning toward the user's favorites."""
+        query = expand_mood(mood)
+        vector = self.embed(query)
+        liked = [v for v in (self.embed(tokenize(record_text(f))) for f in favorites) if v is not None]
+        if liked:
+            preference = np.mean(liked, axis=0)
+            preference /= np.linalg.norm(preference) or 1
+            vector = preference if vector is None else (1 - FAVORITES_WEIGHT) * vector + FAVORITES_WEIGHT * preference
+        if vector is None:
+            return []
+
+        scores = self.docs @ vector.astype(np.float32) + self.prior
+        skip = {normalize_title(f.get('title')) for f in favorites}
+        wanted = min(len(scores), k + len(skip))
+        top = np.argpartition(-scores, wanted - 1)[:wanted]
+        picks = []
+        for i in top[np.argsort(-scores[top])]:
+            record = self.catalog.record(int(i))
+            if normalize_title(record.get('title')) in skip:
+                continue
+            picks.append((record, self._reason(mood, query, record, bool(liked))))
+            if len(picks) == k:
+                break
+        return picks
+
+    @staticmethod
+    def _reason(mood, query, record, used_favorites):
+        shared = [t for t in dict.fromkeys(query) if t in set(tokenize(record_text(record)))]
+        reason = f"Close to '{mood}'" + (f": {', '.join(shared[:3])}" if shared else '')
+        return reason + (', and to movies you liked' if used_favorites else '')
+
+
+def open_recommender(catalog, path=None):
+    # None unless numpy is installed and a model was built for this catalog
+    if np is None or catalog is None:
+        return None
+    path = path or catalog.path + '.lsi'
+    if not os.path.exists(path + '.npz'):
+        return None
+    try:
+        recommender = LocalRecommender(path, catalog)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"DEBUG: Local recommender {path} unusable: {e}")
+        return None
+    print(f"DEBUG: Local recommender loaded ({len(recommender.vocab)} terms, {recommender.terms.shape[1]} dimensions)")
+    return recommender
+
+
+# --- Building ---
+def _sparse_dot(indptr, indices, data, dense, rows, chunk=20000):
+    # (CSR matrix) @ dense, a chunk of rows at a time to bound memory
+    out = np.zeros((rows, dense.shape[1]), dtype=np.float32)
+    for start in range(0, rows, chunk):
+        end = min(start + chunk, rows)
+        lo, hi = indptr[start], indptr[end]
+        if lo == hi:
+            continue
+        products = data[lo:hi, None] * dense[indices[lo:hi]]
+        lengths = np.diff(indptr[start:end + 1])
+        filled = lengths > 0
+        # reduceat sums each row's run of products; empty rows are skipped
+        out[start:end][filled] = np.add.reduceat(products, (indptr[start:end] - lo)[filled], axis=0)
+    return out
+
+def build(catalog, path=None, dimensions=DIMENSIONS, seed=0):
+    path = path or catalog.path + '.lsi'
+    documents = [tokenize(record_text(catalog.record(i))) for i in range(len(catalog))]
+
+    df = Counter()
+    for tokens in documents:
+        df.update(set(tokens))
+    limit = MAX_DF * len(documents)
+    kept = sorted((t for t, n in df.items() if MIN_DF <= n <= limit), key=lambda t: (-df[t], t))[:MAX_TERMS]
+    vocab = {t: i for i, t in enumerate(kept)}
+    idf = np.array([math.log((1 + len(documents)) / (1 + df[t])) + 1 for t in kept], dtype=np.float32)
+
+    # Row-normalised TF-IDF as CSR arrays
+    indptr, indices, data = [0], [], []
+    for tokens in documents:
+        counts = Counter(t for t in tokens if t in vocab)
+        ids = [vocab[t] for t in counts]
+        weights = [(1 + math.log(c)) * idf[vocab[t]] for t, c in counts.items()]
+        norm = math.sqrt(sum(w * w for w in weights)) or 1.0
+        indices.extend(ids)
+        data.extend(w / norm for w in weights)
+        indptr.append(len(indices))
+    indptr = np.array(indptr, dtype=np.int64)
+    indices = np.array(indices, dtype=np.int64)
+    data = np.array(data, dtype=np.float32)
+    # The transpose (CSC of the same matrix) for products on the other side
+    order = np.argsort(indices, kind='stable')
+    t_indptr = np.concatenate([[0], np.cumsum(np.bincount(indices, minlength=len(kept)))])
+    t_indices = np.repeat(np.arange(len(documents)), np.diff(indptr))[order]
+    t_data = data[order]
+    n_docs, n_terms = len(documents), len(kept)
+
+    # Randomised truncated SVD (Halko et al.): range finder with two power iterations
+    rank = max(1, min(dimensions, n_docs - 1, n_terms - 1))
+    rng = np.random.default_rng(seed)
+    sample = _sparse_dot(indptr, indices, data, rng.standard_normal((n_terms, rank + 10)).astype(np.float32), n_docs)
+    for _ in range(2):
+        sample, _ = np.linalg.qr(sample)
+        sample, _ = np.linalg.qr(_sparse_dot(t_indptr, t_indices, t_data, sample, n_terms))
+        sample = _sparse_dot(indptr, indices, data, sample, n_docs)
+    basis, _ = np.linalg.qr(sample)
+    small = _sparse_dot(t_indptr, t_indices, t_data, basis, n_terms).T # basis.T @ X
+    _, _, vt = np.linalg.svd(small, full_matrices=False)
+    terms = np.ascontiguousarray(vt[:rank].T, dtype=np.float32)
+
+    docs = _sparse_dot(indptr, indices, data, terms, n_docs)
+    norms = np.linalg.norm(docs, axis=1, keepdims=True)
+    docs /= np.where(norms > 0, norms, 1)
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    np.savez(tmp + '.npz', vocab=np.array(kept), idf=idf, terms=terms)
+    np.save(tmp + '.npy', docs)
+    os.replace(tmp + '.npy', path + '.npy')
+    os.replace(tmp + '.npz', path + '.npz')
+    return n_docs, n_terms, rank
+
+
+if __name__ == '__main__':
+    from catalog import MovieCatalog
+    parser = argparse.ArgumentParser(description='Build or query the offline LSI recommender')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_cmd = commands.add_parser('build', help='build the model for a catalog file')
+    build_cmd.add_argument('catalog')
+    build_cmd.add_argument('--dimensions', type=int, default=DIMENSIONS)
+    query_cmd = commands.add_parser('query', help='recommend for a mood')
+    query_cmd.add_argument('catalog')
+    query_cmd.add_argument('mood')
+    query_cmd.add_argument('--favorite', action='append', default=[], help='title of a liked movie (repeatable)')
+    args = parser.parse_args()
+    if np is None:
+        sys.exit('numpy is required: pip install numpy')
+
+    catalog = MovieCatalog(args.catalog)
+    if args.command == 'build':
+        start = time.perf_counter()
+        docs, terms, rank = build(catalog, dimensions=args.dimensions)
+        print(f"Built {rank} dimensions over {docs} records and {terms} terms in {time.perf_counter() - start:.1f}s")
+    else:
+        recommender = LocalRecommender(catalog.path + '.lsi', catalog)
+        favorites = [catalog.search(title) or {'title': title} for title in args.favorite]
+        start = time.perf_counter()
+        picks = recommender.recommend(args.mood, favorites)
+        elapsed = time.perf_counter() - start
+        for record, reason in picks:
+            print(f"{record['title']} ({(record.get('release_date') or '')[:4]}) - {reason}")
+        print(f"{elapsed * 1000:.2f} ms", file=sys.stderr)
@@ -0,0 +1,202 @@
+"""
+Process-local metrics in the Prometheus text format (GET /metrics), plus a
+per-request timing breakdown.
+
+Each gunicorn worker keeps its own numbers; scrape every worker (or run a
+single worker) to get the full picture. The breakdown is collected with
+timed('llm' | 'enrich' | 'db' | ...) blocks and returned to the client as
+a Server-Timing header, so a slow /api/recommend shows where its time went
+right in the browser's network tab.
+"""
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Seconds; upstream and LLM calls can run for tens of seconds
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {} # label values -> total
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {} # label values -> [per-bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-2] + [state[-1] - sum(state[:-2])]):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(self.labels, key, [("le", _number(bound))])} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, key)} {_number(state[-2])}'
+            yield f'{self.name}_count{_labels(self.labels, key)} {state[-1]}'
+
+
+class Collected:
+    """Values read from elsewhere at scrape time: collect() yields (label values, value)."""
+    def __init__(self, name, help, kind='gauge', labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.collect = collect
+        _registry.append(self)
+
+    def samples(self):
+        for key, value in self.collect():
+            yield f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            print(f"Metrics collection failed for {metric.name}: {e}")
+            continue
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+# --- Metrics recorded across the backend ---
+request_seconds = Histogram('movieguru_http_request_duration_seconds', 'Request latency by route (time to response headers)',
+                            ['route', 'method', 'status'])
+request_component_seconds = Histogram('movieguru_http_request_component_seconds', 'Time spent per request in each component',
+                                      ['route', 'component'])
+upstream_requests = Counter('movieguru_upstream_requests_total', 'Upstream HTTP attempts by status code ("error" for connection errors and timeouts)',
+                            ['upstream', 'status'])
+upstream_seconds = Histogram('movieguru_upstream_request_duration_seconds', 'Upstream HTTP attempt latency (to response headers)',
+                             ['upstream'])
+model_requests = Counter('movieguru_llm_requests_total', 'OpenRouter model attempts by outcome', ['model', 'outcome'])
+model_seconds = Histogram('movieguru_llm_request_duration_seconds', 'OpenRouter model attempt latency', ['model', 'outcome'])
+db_load_seconds = Histogram('movieguru_db_load_duration_seconds', 'Time to read a collection snapshot or replay its log',
+                            ['collection', 'kind'])
+db_save_seconds = Histogram('movieguru_db_save_duration_seconds', 'Time to serialise and write a collection commit',
+                            ['collection', 'kind'])
+db_bytes_written = Counter('movieguru_db_written_bytes_total', 'Bytes written by collection commits', ['collection', 'kind'])
+jobs = Counter('movieguru_jobs_total', 'Background job runs by outcome (ok, retry, failed)', ['kind', 'outcome'])
+job_seconds = Histogram('movieguru_job_duration_seconds', 'Background job run time', ['kind'])
+job_delay_seconds = Histogram('movieguru_job_delay_seconds', 'Time from submitting a job to each run starting', ['kind'])
+catalog_lookups = Counter('movieguru_catalog_lookups_total', 'Offline catalog title lookups by result (exact, fuzzy, miss)', ['result'])
+
+
+def observe_upstream(upstream, status, seconds):
+    upstream_requests.inc(upstream=upstream, status=status)
+    upstream_seconds.observe(seconds, upstream=upstream)
+
+
+# --- Per-request timing ---
+class RequestTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.totals = {} # component -> seconds
+        self._active = set()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        # Server-Timing header value, durations in milliseconds
+        parts = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.totals.items()]
+        parts.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(parts)
+
+_current = contextvars.ContextVar('movieguru_request_timer', default=None)
+
+def start_request():
+    # Returns a token for finish_request
+    return _current.set(RequestTimer())
+
+def current_timer():
+    return _current.get()
+
+def finish_request(token, route, method, status):
+    timer = _current.get()
+    _current.reset(token)
+    if timer is None:
+        return None
+    request_seconds.observe(timer.elapsed(), route=route, method=method, status=status)
+    for component, seconds in timer.totals.items():
+        request_component_seconds.observe(seconds, route=route, component=component)
+    return timer
+
+@contextmanager
+def timed(component):
+    # Adds the block's wall time to the current request's breakdown. Nested blocks
+    # of the same component (update_doc -> _commit) only count once.
+    timer = _current.get()
+    if timer is None or component in timer._active:
+        yield
+        return
+    timer._active.add(component)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer._active.discard(component)
+        timer.totals[component] = timer.totals.get(component, 0.0) + time.perf_counter() - start
@@ -0,0 +1,259 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+
+
+class ModelHealth:
+    """Rolling latency/error stats and a circuit breaker for one model."""
+    def __init__(self, name, window=50, alpha=0.3, error_half_life=60.0):
+        self.name = name
+        self.alpha = alpha
+        self.error_half_life = error_half_life
+        self.latencies = deque(maxlen=window)
+        self.ewma = None
+        self._error_rate = 0.0 # EWMA of failures, decaying toward 0 while the model is idle
+        self._error_at = time.monotonic()
+        self.failures = 0 # consecutive
+        self.open_until = 0.0
+        self.probing = False # half-open: the one request let through after the cooldown is in flight
+        self.successes_total = 0
+        self.failures_total = 0
+
+    def error_rate(self):
+        idle = time.monotonic() - self._error_at
+        return self._error_rate * 0.5 ** (idle / self.error_half_life)
+
+    def _record_error(self, failed):
+        self._error_rate = self.alpha * failed + (1 - self.alpha) * self.error_rate()
+        self._error_at = time.monotonic()
+
+    def score(self, prior_latency):
+        # Expected time to a good answer; lower is better. Idle models drift back
+        # toward their latency as the error rate decays, so they get re-probed.
+        latency = self.ewma if self.ewma is not None else prior_latency
+        return latency / max(0.05, 1.0 - self.error_rate())
+
+    def record_success(self, latency):
+        self.latencies.append(latency)
+        self.ewma = latency if self.ewma is None else self.alpha * latency + (1 - self.alpha) * self.ewma
+        self._record_error(0)
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.successes_total += 1
+
+    def record_failure(self, threshold, cooldown):
+        self._record_error(1)
+        self.failures += 1
+        self.failures_total += 1
+        self.probing = False
+        if self.failures >= threshold:
+            # Open the breaker (again, if this was the half-open probe)
+            self.open_until = time.monotonic() + cooldown
+
+    def is_open(self):
+        return self.open_until > time.monotonic()
+
+    def admit(self):
+        # Closed: always. Open: never. Half-open (cooldown over, not yet recovered): one probe at a time
+        if self.is_open():
+            return False
+        if self.open_until:
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def snapshot(self):
+        return {
+            'ewma_latency': round(self.ewma, 3) if self.ewma is not None else None,
+            'error_rate': round(self.error_rate(), 3),
+            'p90_latency': self.percentile(0.9),
+            'consecutive_failures': self.failures,
+            'circuit_open': self.is_open(),
+            'half_open': bool(self.open_until) and not self.is_open(),
+            'successes': self.successes_total,
+            'failures': self.failures_total,
+        }
+
+
+class ModelRouter:
+    """Races a call across an ordered list of models.
+
+    The first model starts immediately. If it has not produced a valid
+    result after its hedge delay (the `hedge_percentile` of its recent
+    latencies, or `default_hedge_delay` while there is too little data), or
+    it fails outright, the next model is started as well; the first valid
+    result wins. With hedge=False this degrades to plain sequential fallback.
+
+    Models are re-ordered on every call: closed circuits first, then by EWMA
+    latency inflated by the recent error rate, then by configured priority.
+    Models whose circuit is open are skipped entirely. Once the cooldown has
+    passed the circuit is half-open: a single request is admitted as a probe
+    and its outcome closes the circuit or opens it for another cooldown.
+    """
+    def __init__(self, models, hedge=True, hedge_percentile=0.9, default_hedge_delay=4.0,
+                 min_samples=5, failure_threshold=3, cooldown=60.0, max_workers=16):
+        self.models = list(models)
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_samples = min_samples
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health = {model: ModelHealth(model) for model in self.models}
+        self._lock = threading.Lock()
+        # Losing requests can't be cancelled mid-flight; they finish here and still update health
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm')
+        self._background = set() # losing asyncio tasks, referenced until they finish
+
+    def ordered_models(self):
+        # Candidates for one call; each must still pass admit() right before it is started
+        with self._lock:
+            def rank(item):
+                index, model = item
+                health = self.health[model]
+                return (bool(health.open_until), health.score(self.default_hedge_delay), index)
+            candidates = [(index, model) for index, model in enumerate(self.models) if not self.health[model].is_open()]
+            return [model for _, model in sorted(candidates, key=rank)]
+
+    def admit(self, model):
+        """True if `model` may be called now. Claims the half-open probe, so the
+        caller must follow up with record() (or release() if it never ran)."""
+        with self._lock:
+            return self.health[model].admit()
+
+    def release(self, model):
+        # An admitted call that ended without an outcome (cancelled): free the probe slot
+        with self._lock:
+            self.health[model].probing = False
+
+    def hedge_delay(self, model):
+        if not self.hedge:
+            return None
+        with self._lock:
+            health = self.health[model]
+            if len(health.latencies) < self.min_samples:
+                return self.default_hedge_delay
+            return health.percentile(self.hedge_percentile)
+
+    def record(self, model, ok, latency=None):
+        outcome = 'ok' if ok else 'failure'
+        metrics.model_requests.inc(model=model, outcome=outcome)
+        if latency is not None:
+            metrics.model_seconds.observe(latency, model=model, outcome=outcome)
+        with self._lock:
+            health = self.health[model]
+            if ok:
+                health.record_success(latency)
+            else:
+                health.record_failure(self.failure_threshold, self.cooldown)
+
+    def _attempt(self, call, model):
+        start = time.monotonic()
+        try:
+            result = call(model)
+        except Exception as e:
+            print(f"Model {model} failed: {e}")
+            result = None
+        self.record(model, result is not None, time.monotonic() - start)
+        return result
+
+    def run(self, call, deadline=None):
+        """call(model) returns a valid result, or None / raises on failure.
+
+        Returns (model, result) for the first valid result, or (None, None)
+        if every model failed or the deadline passed.
+        """
+        queue = self.ordered_models()
+        running = {}
+        next_start = time.monotonic()
+        while queue or running:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                break
+            if queue and (not running or (next_start is not None and now >= next_start)):
+                model = queue.pop(0)
+                if not self.admit(model):
+                    continue
+                running[self._pool.submit(self._attempt, call, model)] = model
+                delay = self.hedge_delay(model)
+                next_start = now + delay if delay is not None else None
+
+            timeouts = []
+            if deadline is not None:
+                timeouts.append(deadline - time.monotonic())
+            if queue and next_start is not None:
+                timeouts.append(next_start - time.monotonic())
+            done, _ = wait(running, timeout=max(0.0, min(timeouts)) if timeouts else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                model = running.pop(future)
+                if future.result() is not None:
+                    return model, future.result()
+                # Failed outright: start the next model now instead of waiting out the hedge delay
+                next_start = time.monotonic()
+        return None, None
+
+    async def _attempt_async(self, call, model):
+        start = time.monotonic()
+        try:
+            result = await call(model)
+        except Exception as e:
+            print(f"Model {model} failed: {e}")
+            result = None
+        self.record(model, result is not None, time.monotonic() - start)
+        return result
+
+    async def run_async(self, call, deadline=None):
+        """run() for a coroutine function call(model), on the running event loop."""
+        queue = self.ordered_models()
+        running = {}
+        next_start = time.monotonic()
+        try:
+            while queue or running:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                if queue and (not running or (next_start is not None and now >= next_start)):
+                    model = queue.pop(0)
+                    if not self.admit(model):
+                        continue
+                    task = asyncio.ensure_future(self._attempt_async(call, model))
+                    # A cancelled attempt never reaches record(), so it would hold the probe forever
+                    task.add_done_callback(lambda t, model=model: t.cancelled() and self.release(model))
+                    running[task] = model
+                    delay = self.hedge_delay(model)
+                    next_start = now + delay if delay is not None else None
+
+                timeouts = []
+                if deadline is not None:
+                    timeouts.append(deadline - time.monotonic())
+                if queue and next_start is not None:
+                    timeouts.append(next_start - time.monotonic())
+                done, _ = await asyncio.wait(running, timeout=max(0.0, min(timeouts)) if timeouts else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    model = running.pop(task)
+                    if task.result() is not None:
+                        return model, task.result()
+                    next_start = time.monotonic()
+            return None, None
+        finally:
+            # As in run(), losers keep going so their latency still feeds the health stats
+            for task in running:
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+
+    def stats(self):
+        with self._lock:
+            return {model: health.snapshot() for model, health in self.health.items()}
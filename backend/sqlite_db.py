@@ -0,0 +1,319 @@
+"""
+SQLite backend with the same surface as local_db.LocalDB: collection /
+document / where / order_by / limit / start_after / stream / add / set /
+update / delete, plus batch() and transaction(). Selected with
+MOVIEGURU_DB_STORAGE=sqlite.
+
+Each collection is a table of (id, data) rows with data as a JSON column.
+The INDEXES / SORTED_INDEXES fields from local_db become expression
+indexes on json_extract(data, '$.field'). The database runs in WAL mode,
+so readers never block the writer. Every thread of every worker process
+keeps its own connection.
+
+The first time a collection is opened, its <name>.json snapshot (and any
+write-ahead log) is imported. To re-run that import by hand:
+
+    python sqlite_db.py --force
+"""
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+import datetime
+import argparse
+import threading
+from contextlib import contextmanager
+import metrics
+from local_db import (DATA_DIR, LIST_COLLECTIONS, INDEXES, SORTED_INDEXES,
+                      LocalDocument, LocalCollection, WalStorage, WriteBatch, Transaction, resolve_timestamps)
+
+SQLITE_PATH = os.environ.get('MOVIEGURU_SQLITE_PATH', os.path.join(DATA_DIR, 'movieguru.db'))
+
+NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def _name(name):
+    # Collection and field names are inlined into SQL (so expression indexes match)
+    if not NAME_RE.match(name):
+        raise ValueError(f"Unsupported name: {name!r}")
+    return name
+
+def _field(field):
+    return f"json_extract(data, '$.{_name(field)}')"
+
+def _sort_key(field):
+    # Missing values order as '', the same as QueryView
+    return f"COALESCE({_field(field)}, '')"
+
+
+class SqliteConnections:
+    """One connection per thread, re-opened in forked worker processes."""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _state(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            local.conn, local.pid, local.depth = conn, os.getpid(), 0
+        return local
+
+    def get(self):
+        return self._state().conn
+
+    @contextmanager
+    def write(self):
+        # BEGIN IMMEDIATE takes the database write lock up front. Re-entrant, so
+        # batches and transactions spanning collections commit as one SQLite transaction.
+        local = self._state()
+        if local.depth:
+            local.depth += 1
+            try:
+                yield local.conn
+            finally:
+                local.depth -= 1
+            return
+        local.conn.execute('BEGIN IMMEDIATE')
+        local.depth = 1
+        try:
+            yield local.conn
+        except BaseException:
+            local.depth = 0
+            local.conn.execute('ROLLBACK')
+            raise
+        local.depth = 0
+        local.conn.execute('COMMIT')
+
+
+class SqliteCollection:
+    def __init__(self, name, connections):
+        self.name = _name(name)
+        self._connections = connections
+        self._is_list = name in LIST_COLLECTIONS
+        with self._locked() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.name}" (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            for sql in self._index_sql():
+                conn.execute(sql)
+            conn.execute('CREATE TABLE IF NOT EXISTS _versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            conn.execute('INSERT OR IGNORE INTO _versions (name, version) VALUES (?, 0)', (self.name,))
+            self._import_json(conn)
+
+    def _index_sql(self):
+        sorted_fields = SORTED_INDEXES.get(self.name, []) if self._is_list else []
+        for field in sorted_fields:
+            yield f'CREATE INDEX IF NOT EXISTS "{self.name}_by_{field}" ON "{self.name}" ({_sort_key(field)}, id)'
+        for field in INDEXES.get(self.name, []):
+            # Equality field first, then the sort key: where(field).order_by(sorted) is one index range
+            columns = [_field(field)] + ([_sort_key(sorted_fields[0]), 'id'] if sorted_fields else [])
+            yield f'CREATE INDEX IF NOT EXISTS "{self.name}_{field}" ON "{self.name}" ({", ".join(columns)})'
+
+    def create_index(self, field):
+        with self._locked() as conn:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.name}_{_name(field)}" ON "{self.name}" ({_field(field)})')
+
+    def _import_json(self, conn, force=False):
+        # One-shot import from the JSON files, remembered in _imported so it never re-runs
+        conn.execute('CREATE TABLE IF NOT EXISTS _imported (name TEXT PRIMARY KEY, at TEXT)')
+        if force:
+            conn.execute(f'DELETE FROM "{self.name}"')
+            conn.execute('DELETE FROM _imported WHERE name = ?', (self.name,))
+        elif conn.execute('SELECT 1 FROM _imported WHERE name = ?', (self.name,)).fetchone():
+            return
+        source = LocalCollection(self.name, storage=WalStorage) # reads the snapshot plus any WAL
+        rows = [(doc_id, json.dumps(record, default=str)) for doc_id, record in source._items()]
+        conn.executemany(f'INSERT OR IGNORE INTO "{self.name}" (id, data) VALUES (?, ?)', rows)
+        conn.execute('UPDATE _versions SET version = version + 1 WHERE name = ?', (self.name,))
+        conn.execute('INSERT INTO _imported (name, at) VALUES (?, ?)', (self.name, datetime.datetime.now().isoformat()))
+        if rows:
+            print(f"DEBUG: Imported {len(rows)} {self.name} records into SQLite")
+
+    # Same internal hooks as LocalCollection, so local_db's WriteBatch / Transaction work unchanged
+    def _locked(self):
+        return self._connections.write()
+
+    def _refresh(self):
+        pass # every read goes to the database
+
+    def _get(self, doc_id):
+        with metrics.timed('db'):
+            row = self._connections.get().execute(f'SELECT data FROM "{self.name}" WHERE id = ?', (str(doc_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def version(self):
+        # Write counter kept in the database, so it is shared by every worker
+        return self._connections.get().execute('SELECT version FROM _versions WHERE name = ?', (self.name,)).fetchone()[0]
+
+    def _commit(self, ops):
+        start, written = time.perf_counter(), 0
+        with metrics.timed('db'), self._locked() as conn:
+            if ops:
+                conn.execute('UPDATE _versions SET version = version + 1 WHERE name = ?', (self.name,))
+            for op in resolve_timestamps(ops):
+                doc_id = str(op['id'])
+                if op['op'] == 'set':
+                    data = op['data']
+                    if self._is_list:
+                        data['id'] = doc_id
+                    text = json.dumps(data, default=str)
+                    written += len(text)
+                    if op.get('replace') is not None:
+                        conn.execute(f'DELETE FROM "{self.name}" WHERE id = ?', (str(op['replace']),))
+                    # Upsert keeps the rowid, so a replaced record keeps its insertion position
+                    conn.execute(f'INSERT INTO "{self.name}" (id, data) VALUES (?, ?) '
+                                 'ON CONFLICT(id) DO UPDATE SET data = excluded.data',
+                                 (doc_id, text))
+                elif op['op'] == 'delete':
+                    conn.execute(f'DELETE FROM "{self.name}" WHERE id = ?', (doc_id,))
+        # Inside a batch this is the time to stage the rows; the COMMIT happens at the outermost write()
+        metrics.db_save_seconds.observe(time.perf_counter() - start, collection=self.name, kind='sqlite')
+        metrics.db_bytes_written.inc(written, collection=self.name, kind='sqlite')
+
+    def document(self, doc_id):
+        return LocalDocument(self._get(doc_id), doc_id, self)
+
+    def set_doc(self, doc_id, data):
+        self._commit([{'op': 'set', 'id': doc_id, 'data': data}])
+
+    def delete_doc(self, doc_id):
+        self._commit([{'op': 'delete', 'id': doc_id}])
+
+    def update_doc(self, doc_id, fn):
+        # Atomic read-modify-write under the database write lock
+        with self._locked():
+            current = self._get(doc_id)
+            if current is None:
+                return None
+            new = fn(dict(current))
+            self._commit([{'op': 'set', 'id': doc_id, 'data': new}])
+            return new
+
+    def add(self, data):
+        if not self._is_list:
+            return None, None
+        doc_id = str(uuid.uuid4())
+        data['id'] = doc_id
+        self._commit([{'op': 'set', 'id': doc_id, 'data': data}])
+        return datetime.datetime.now(), self.document(doc_id)
+
+    # Query methods
+    def where(self, field, op, value):
+        return SqliteQuery(self).where(field, op, value)
+
+    def order_by(self, field, direction='desc'):
+        return SqliteQuery(self).order_by(field, direction)
+
+    def stream(self):
+        return SqliteQuery(self).stream()
+
+
+class SqliteQuery:
+    # Same composition rules as local_db.QueryView, compiled to one SELECT in stream()
+    __slots__ = ('collection', 'filters', 'order', '_limit', 'cursor')
+
+    def __init__(self, collection, filters=(), order=None, limit=None, cursor=None):
+        self.collection = collection
+        self.filters = filters
+        self.order = order
+        self._limit = limit
+        self.cursor = cursor
+
+    def _derive(self, **changes):
+        state = {'filters': self.filters, 'order': self.order, 'limit': self._limit, 'cursor': self.cursor}
+        state.update(changes)
+        return SqliteQuery(self.collection, **state)
+
+    def where(self, field, op, value):
+        if op != '==':
+            raise NotImplementedError(f"Unsupported query operator: {op}")
+        return self._derive(filters=self.filters + ((field, value),))
+
+    def order_by(self, field, direction='desc'):
+        if self.collection._is_list:
+            return self._derive(order=(field, direction))
+        return self
+
+    def limit(self, limit):
+        if self.collection._is_list:
+            return self._derive(limit=limit)
+        return self
+
+    def start_after(self, cursor):
+        if not self.order:
+            raise ValueError("start_after() requires order_by()")
+        if isinstance(cursor, LocalDocument):
+            cursor = (cursor.to_dict().get(self.order[0], ''), cursor.id)
+        value, doc_id = cursor
+        return self._derive(cursor=(value, str(doc_id)))
+
+    def _sql(self):
+        clauses, params = [], []
+        for field, value in self.filters:
+            clauses.append(f'{_field(field)} IS ?')
+            params.append(value)
+        order = 'rowid' # insertion order, as in the JSON files
+        if self.order:
+            field, direction = self.order
+            op, sql_direction = ('<', 'DESC') if direction == 'desc' else ('>', 'ASC')
+            if self.cursor is not None:
+                # The redundant single-column bound lets SQLite seek the index instead of scanning it
+                clauses.append(f'{_sort_key(field)} {op}= ? AND ({_sort_key(field)}, id) {op} (?, ?)')
+                params.extend([self.cursor[0], *self.cursor])
+            order = f'{_sort_key(field)} {sql_direction}, id {sql_direction}'
+        sql = f'SELECT id, data FROM "{self.collection.name}"'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += f' ORDER BY {order}'
+        if self._limit is not None:
+            sql += ' LIMIT ?'
+            params.append(self._limit)
+        return sql, params
+
+    def stream(self):
+        sql, params = self._sql()
+        # fetchall: an abandoned cursor would pin an old WAL read snapshot
+        with metrics.timed('db'):
+            rows = self.collection._connections.get().execute(sql, params).fetchall()
+        for doc_id, data in rows:
+            yield LocalDocument(json.loads(data), doc_id, self.collection)
+
+
+class SqliteDB:
+    def __init__(self, path=None):
+        self.path = path or SQLITE_PATH
+        self._connections = SqliteConnections(self.path)
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def collection(self, name):
+        coll = self._collections.get(name)
+        if coll is None:
+            with self._lock:
+                coll = self._collections.get(name)
+                if coll is None:
+                    coll = self._collections[name] = SqliteCollection(name, self._connections)
+        return coll
+
+    def batch(self):
+        return WriteBatch()
+
+    def transaction(self):
+        return Transaction()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import the JSON collections into the SQLite database')
+    parser.add_argument('--force', action='store_true', help='replace rows already imported')
+    parser.add_argument('collections', nargs='*', default=['users'] + LIST_COLLECTIONS)
+    args = parser.parse_args()
+
+    db = SqliteDB()
+    for name in args.collections:
+        coll = db.collection(name)
+        if args.force:
+            with coll._locked() as conn:
+                coll._import_json(conn, force=True)
+    print(f"SQLite database: {db.path}")
@@ -0,0 +1,103 @@
+"""
+Multi-process stress test for the local database (JSON, WAL or SQLite).
+
+Spawns several worker processes that hammer one data directory the same way
+gunicorn workers would, then checks that no update was lost:
+
+    python stress_test_db.py --processes 8 --iterations 200 --storage wal
+
+--storage all also runs WAL with a tiny compaction threshold, so log
+compaction happens many times while the workers write.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+
+def worker(data_dir, storage, worker_id, iterations, compact_bytes=None):
+    db = open_db(data_dir, storage, compact_bytes)
+    counter = db.collection('users').document('counter')
+    posts = db.collection('posts')
+    for i in range(iterations):
+        # Read-modify-write on a single shared document
+        counter.update(lambda current: {'value': current.get('value', 0) + 1})
+        # Blind appends into a list collection
+        posts.add({'author': f'worker-{worker_id}', 'seq': i, 'timestamp': time.time()})
+
+
+def run(processes, iterations, storage, compact_bytes=None):
+    data_dir = tempfile.mkdtemp(prefix='movieguru-stress-')
+    try:
+        # The DB module reads its config at import time, so every step runs in its own process
+        seeder = multiprocessing.Process(target=seed, args=(data_dir, storage))
+        seeder.start()
+        seeder.join()
+
+        start = time.time()
+        procs = [multiprocessing.Process(target=worker, args=(data_dir, storage, n, iterations, compact_bytes)) for n in range(processes)]
+        for p in procs: p.start()
+        for p in procs: p.join()
+        elapsed = time.time() - start
+
+        # Read back from a fresh process so nothing is served from a warm cache
+        check = multiprocessing.Queue()
+        reader = multiprocessing.Process(target=read_back, args=(data_dir, storage, check))
+        reader.start()
+        value, post_count, seqs = check.get()
+        reader.join()
+
+        expected = processes * iterations
+        ok = value == expected and post_count == expected and seqs == expected
+        label = storage if compact_bytes is None else f"{storage}, compact at {compact_bytes} bytes"
+        print(f"[{label}] {processes} procs x {iterations} iters in {elapsed:.2f}s "
+              f"({2 * expected / elapsed:.0f} writes/s)")
+        print(f"  counter: {value}/{expected}  posts: {post_count}/{expected}  unique (worker, seq): {seqs}/{expected}")
+        print("  OK" if ok else "  LOST UPDATES")
+        return ok and all(p.exitcode == 0 for p in procs)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def open_db(data_dir, storage, compact_bytes=None):
+    os.environ['MOVIEGURU_DATA_DIR'] = data_dir
+    os.environ['MOVIEGURU_DB_STORAGE'] = storage
+    if compact_bytes is not None:
+        os.environ['MOVIEGURU_WAL_COMPACT_BYTES'] = str(compact_bytes)
+    if storage == 'sqlite':
+        from sqlite_db import SqliteDB
+        return SqliteDB()
+    from local_db import LocalDB
+    return LocalDB()
+
+
+def seed(data_dir, storage):
+    open_db(data_dir, storage).collection('users').set_doc('counter', {'value': 0})
+
+
+def read_back(data_dir, storage, out):
+    db = open_db(data_dir, storage)
+    value = db.collection('users').document('counter').to_dict().get('value')
+    posts = [doc.to_dict() for doc in db.collection('posts').stream()]
+    seqs = len({(p['author'], p['seq']) for p in posts})
+    out.put((value, len(posts), seqs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=6)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--storage', choices=['json', 'wal', 'sqlite', 'all'], default='all')
+    parser.add_argument('--compact-bytes', type=int, default=None, help='WAL compaction threshold (default: the app\'s)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if args.storage == 'all':
+        modes = [('json', None), ('wal', args.compact_bytes), ('wal', 2000), ('sqlite', None)]
+    else:
+        modes = [(args.storage, args.compact_bytes)]
+    results = [run(args.processes, args.iterations, mode, compact_bytes) for mode, compact_bytes in modes]
+    sys.exit(0 if all(results) else 1)
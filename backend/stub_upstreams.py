@@ -0,0 +1,201 @@
+"""
+Local stand-ins for OpenRouter, TMDB and OMDb with injectable latency and
+failures, for offline benchmarks:
+
+    python stub_upstreams.py --port 8900 --tmdb-latency 0.2 --llm-latency 1.5
+
+then point the backend at it with the printed environment variables.
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Small fixed catalog the stub LLM recommends from and the stub TMDB/OMDb resolve
+STUB_MOVIES = [
+    {"id": 27205, "title": "Inception", "year": "2010", "rating": 8.4, "overview": "A thief steals secrets through dream-sharing."},
+    {"id": 157336, "title": "Interstellar", "year": "2014", "rating": 8.4, "overview": "Explorers travel through a wormhole in space."},
+    {"id": 155, "title": "The Dark Knight", "year": "2008", "rating": 8.5, "overview": "Batman faces the Joker."},
+    {"id": 13, "title": "Forrest Gump", "year": "1994", "rating": 8.5, "overview": "A kind man witnesses decades of history."},
+    {"id": 120467, "title": "The Grand Budapest Hotel", "year": "2014", "rating": 8.0, "overview": "A concierge and his lobby boy."},
+    {"id": 8587, "title": "The Lion King", "year": "1994", "rating": 8.3, "overview": "A lion cub flees his kingdom."},
+    {"id": 194, "title": "Amelie", "year": "2001", "rating": 7.9, "overview": "A shy waitress helps those around her."},
+    {"id": 11036, "title": "The Notebook", "year": "2004", "rating": 7.9, "overview": "A poor young man falls for a rich girl."},
+    {"id": 637, "title": "Life Is Beautiful", "year": "1997", "rating": 8.5, "overview": "A father shields his son in a camp."},
+    {"id": 152601, "title": "Her", "year": "2013", "rating": 7.9, "overview": "A lonely writer falls for an operating system."},
+]
+
+
+class StubUpstreams:
+    """Threaded HTTP server answering OpenRouter, TMDB and OMDb style requests.
+
+    latency / failure_rate are per upstream ('llm', 'tmdb', 'omdb');
+    model_latency / model_failure_rate override the 'llm' values for specific
+    models; slow_titles adds extra delay to lookups of specific titles.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=None, failure_rate=None, slow_titles=None, jitter=0.0,
+                 model_latency=None, model_failure_rate=None):
+        self.latency = {'llm': 0.0, 'tmdb': 0.0, 'omdb': 0.0, **(latency or {})}
+        self.failure_rate = {'llm': 0.0, 'tmdb': 0.0, 'omdb': 0.0, **(failure_rate or {})}
+        self.slow_titles = {k.lower(): v for k, v in (slow_titles or {}).items()}
+        self.jitter = jitter
+        self.model_latency = dict(model_latency or {})
+        self.model_failure_rate = dict(model_failure_rate or {})
+        self.model_counts = {}
+        self.counts = {'llm': 0, 'tmdb': 0, 'omdb': 0}
+        self._counts_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def env(self):
+        # Environment overrides that point app.py at this server
+        return {
+            'OPENROUTER_URL': f'{self.base_url}/api/v1/chat/completions',
+            'TMDB_BASE_URL': f'{self.base_url}/3',
+            'OMDB_URL': f'{self.base_url}/omdb/',
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _delay(self, upstream, title=None, model=None):
+        # Sleep for the configured latency; True means "inject a failure"
+        with self._counts_lock:
+            self.counts[upstream] += 1
+            if model:
+                self.model_counts[model] = self.model_counts.get(model, 0) + 1
+        delay = self.model_latency.get(model, self.latency[upstream]) + random.uniform(0, self.jitter)
+        if title:
+            delay += self.slow_titles.get(title.lower(), 0.0)
+        if delay:
+            time.sleep(delay)
+        return random.random() < self.model_failure_rate.get(model, self.failure_rate[upstream])
+
+    @staticmethod
+    def find(title):
+        title = (title or '').lower()
+        return next((m for m in STUB_MOVIES if m['title'].lower() == title), None)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                if not self.path.startswith('/api/v1/chat/completions'):
+                    return self._send(404, {'error': 'not found'})
+                picks = random.sample(STUB_MOVIES, 5)
+                content = json.dumps([{'title': m['title'], 'reason': m['overview']} for m in picks])
+                if payload.get('stream'):
+                    return self._stream(payload, content)
+                if stub._delay('llm', model=payload.get('model')):
+                    return self._send(503, {'error': {'message': 'injected failure'}})
+                self._send(200, {'model': payload.get('model'), 'choices': [{'message': {'role': 'assistant', 'content': content}}]})
+
+            def _stream(self, payload, content, chunk_size=12):
+                # First token after 20% of the LLM latency, the rest spread over the reply
+                model = payload.get('model')
+                with stub._counts_lock:
+                    stub.counts['llm'] += 1
+                    stub.model_counts[model] = stub.model_counts.get(model, 0) + 1
+                total = stub.model_latency.get(model, stub.latency['llm']) + random.uniform(0, stub.jitter)
+                time.sleep(total * 0.2)
+                if random.random() < stub.model_failure_rate.get(model, stub.failure_rate['llm']):
+                    return self._send(503, {'error': {'message': 'injected failure'}})
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+                for chunk in chunks:
+                    event = {'model': payload.get('model'), 'choices': [{'delta': {'content': chunk}}]}
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                    time.sleep(total * 0.8 / len(chunks))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path.startswith('/3/search/movie'):
+                    title = params.get('query')
+                    if stub._delay('tmdb', title):
+                        return self._send(503, {'status_message': 'injected failure'})
+                    m = stub.find(title)
+                    results = [{
+                        'id': m['id'], 'title': m['title'], 'poster_path': f"/{m['id']}.jpg",
+                        'overview': m['overview'], 'vote_average': m['rating'], 'release_date': f"{m['year']}-01-01",
+                    }] if m else []
+                    return self._send(200, {'results': results})
+                if url.path.startswith('/omdb'):
+                    title = params.get('t')
+                    if stub._delay('omdb', title):
+                        return self._send(503, {'Response': 'False', 'Error': 'injected failure'})
+                    m = stub.find(title)
+                    if not m:
+                        return self._send(200, {'Response': 'False', 'Error': 'Movie not found!'})
+                    return self._send(200, {
+                        'Response': 'True', 'Title': m['title'], 'Year': m['year'], 'Plot': m['overview'],
+                        'imdbID': f"tt{m['id']:07d}", 'imdbRating': str(m['rating']),
+                        'Poster': f"https://example.invalid/{m['id']}.jpg", 'Released': f"01 Jan {m['year']}",
+                    })
+                self._send(404, {'error': 'not found'})
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run stub OpenRouter/TMDB/OMDb upstreams')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--tmdb-latency', type=float, default=0.2)
+    parser.add_argument('--omdb-latency', type=float, default=0.2)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='applied to every upstream')
+    args = parser.parse_args()
+
+    stub = StubUpstreams(
+        port=args.port,
+        latency={'llm': args.llm_latency, 'tmdb': args.tmdb_latency, 'omdb': args.omdb_latency},
+        failure_rate={k: args.failure_rate for k in ('llm', 'tmdb', 'omdb')},
+    )
+    for key, value in stub.env().items():
+        print(f'export {key}={value}')
+    print('Serving stub upstreams, Ctrl+C to stop')
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
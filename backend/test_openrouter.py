@@ -1,73 +1,84 @@
+"""
+Local benchmark for the OpenRouter model fallback strategy.
 
+Starts stub OpenRouter servers (see stub_upstreams.py) where each free-tier
+model has its own latency and failure rate, then sends the same stream of
+recommendation requests through app.model_router configured for plain
+sequential fallback and for hedged racing, and compares the latencies:
+
+    python test_openrouter.py --requests 40 --fail-rate 0.3
+
+Nothing here talks to the real OpenRouter API.
+"""
 import os
-import requests
-import json
-from dotenv import load_dotenv
+import sys
+import time
+import argparse
+import tempfile
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))] if ordered else float('nan')
 
-# Load environment variables
-load_dotenv()
 
-# Get API key
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sequential vs hedged model fallback against stub servers')
+    parser.add_argument('--requests', type=int, default=30)
+    parser.add_argument('--fail-rate', type=float, default=0.3, help='failure rate of the first (primary) model')
+    parser.add_argument('--latencies', default='1.0,1.5,2.5', help='base latency (s) per model, in MODELS_TO_TRY order')
+    parser.add_argument('--jitter', type=float, default=1.0, help='extra uniform random latency (s) on every call')
+    parser.add_argument('--hedge-percentile', type=float, default=0.9)
+    args = parser.parse_args()
 
-# Sanitize key
-if OPENROUTER_API_KEY:
-    OPENROUTER_API_KEY = OPENROUTER_API_KEY.strip().replace('"', '').replace("'", "")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from stub_upstreams import StubUpstreams
 
-print(f"Testing OpenRouter API")
-print(f"API Key found: {'Yes' if OPENROUTER_API_KEY else 'No'}")
-if OPENROUTER_API_KEY:
-    print(f"Key preview: {OPENROUTER_API_KEY[:10]}...{OPENROUTER_API_KEY[-5:]}")
+    # Model names must match the app's list before the app is imported, so read them after
+    latencies = [float(x) for x in args.latencies.split(',')]
+    stub = StubUpstreams(jitter=args.jitter).start()
+    data_dir = tempfile.TemporaryDirectory(prefix='movieguru-bench-')
+    os.environ.update(stub.env())
+    os.environ['OPENROUTER_API_KEY'] = 'stub-openrouter-key'
+    os.environ['MOVIEGURU_DATA_DIR'] = data_dir.name # keep the app off the real JSON files
+    import app
+    from model_router import ModelRouter
 
-# Models to try (Free tier)
-models_to_try = [
-    "openrouter/free",
-    "google/gemini-2.0-flash-exp:free",
-    "google/gemini-2.0-pro-exp-02-05:free", # Retrying just in case
-    "mistralai/mistral-7b-instruct-v0.3:free"
-]
+    models = app.MODELS_TO_TRY
+    stub.model_latency = dict(zip(models, latencies))
+    stub.model_failure_rate = {models[0]: args.fail_rate}
+    prompt = app.build_recommend_prompt('benchmark mood')
 
-with open("openrouter_debug_utf8.txt", "w", encoding="utf-8") as f:
-    f.write("") # Clear file
+    def ask(model):
+        response = app.openrouter_call(model, prompt)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        return app.parse_recommendations(response.json()['choices'][0]['message']['content']) or None
 
-for model in models_to_try:
-    print(f"\nTesting model: {model}")
-    
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {OPENROUTER_API_KEY}',
-        'HTTP-Referer': 'http://localhost:5173',
-        'X-Title': 'MovieGuru'
-    }
-    payload = {
-        "messages": [
-            {"role": "user", "content": "Suggest one sci-fi movie. format: json with title and reason."}
-        ],
-        "model": model,
-        "temperature": 0.7
-    }
+    print(f"Models: {', '.join(f'{m} ({l}s)' for m, l in zip(models, latencies))}; "
+          f"jitter {args.jitter}s; {models[0]} fails {args.fail_rate:.0%}\n")
+    for label, hedge in [('sequential', False), (f'hedged p{int(args.hedge_percentile * 100)}', True)]:
+        router = ModelRouter(models, hedge=hedge, hedge_percentile=args.hedge_percentile,
+                             default_hedge_delay=max(latencies[0] + args.jitter, 0.1))
+        stub.model_counts = {}
+        timings, winners, failures = [], {}, 0
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            model, result = router.run(ask)
+            timings.append(time.perf_counter() - start)
+            if result is None:
+                failures += 1
+            else:
+                winners[model] = winners.get(model, 0) + 1
+        # Give hedged losers a moment to finish so upstream call counts are complete
+        time.sleep(max(latencies) + args.jitter)
+        print(f"{label:>12}: p50 {percentile(timings, 0.5):.2f}s  p95 {percentile(timings, 0.95):.2f}s  "
+              f"p99 {percentile(timings, 0.99):.2f}s  failed {failures}/{args.requests}")
+        print(f"{'':>12}  winners {winners}")
+        print(f"{'':>12}  upstream calls {sum(stub.model_counts.values())} {stub.model_counts}")
+    stub.stop()
+    data_dir.cleanup()
 
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        print(f"Status Code: {response.status_code}")
-        
-        with open("openrouter_debug_utf8.txt", "a", encoding="utf-8") as f:
-            f.write(f"\nTesting model: {model}\n")
-            f.write(f"Status Code: {response.status_code}\n")
 
-        if response.status_code == 200:
-            content = response.json()['choices'][0]['message']['content']
-            print(f"Success with {model}!")
-            print(content)
-            with open("openrouter_debug_utf8.txt", "a", encoding="utf-8") as f:
-                f.write(f"Success with {model}!\n")
-                f.write(content + "\n")
-            break # Stop after first success
-        else:
-            print(f"Error: {response.text}")
-            with open("openrouter_debug_utf8.txt", "a", encoding="utf-8") as f:
-                f.write(f"Error: {response.text}\n")
-                
-    except Exception as e:
-        print(f"Exception: {e}")
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,8 @@ const Reviews = () => {
     const [editingComment, setEditingComment] = useState(null);
     const [newPost, setNewPost] = useState({ movieTitle: '', content: '', rating: 5, anonymous: false });
     const [newComment, setNewComment] = useState('');
+    const [comments, setComments] = useState([]);
+    const [commentsPostId, setCommentsPostId] = useState(null);
 
     useEffect(() => {
         fetchPosts();
@@ -29,10 +31,40 @@ const Reviews = () => {
         };
     }, []);
 
+    // Posts only carry their latest few comments; the full thread is loaded when one is opened
+    useEffect(() => {
+        if (selectedPost) {
+            fetchComments(selectedPost.id);
+        } else {
+            setComments([]);
+            setCommentsPostId(null);
+        }
+    }, [selectedPost?.id]);
+
+    const fetchComments = async (postId) => {
+        try {
+            // Follow next_cursor so threads longer than one page come back whole
+            let thread = [];
+            let cursor = null;
+            do {
+                const params = cursor ? { page_size: 100, cursor } : { page_size: 100 };
+                const response = await api.get(`/posts/${postId}/comments`, { params });
+                thread = thread.concat(response.data.items);
+                cursor = response.data.next_cursor;
+            } while (cursor);
+            setComments(thread);
+            setCommentsPostId(postId);
+        } catch (error) {
+            console.error('Error fetching comments:', error);
+        }
+    };
+
     const fetchPosts = async () => {
         try {
             const response = await api.get('/posts');
             setPosts(response.data);
+            // Keep the open post in step with the refreshed list (edits, comment counts)
+            setSelectedPost(prev => prev && (response.data.find(post => post.id === prev.id) || prev));
         } catch (error) {
             console.error('Error fetching posts:', error);
         }
@@ -101,6 +133,7 @@ const Reviews = () => {
 
             setNewComment('');
             fetchPosts();
+            fetchComments(postId);
         } catch (error) {
             console.error('Error adding comment:', error);
         }
@@ -115,6 +148,7 @@ const Reviews = () => {
 
             setEditingComment(null);
             fetchPosts();
+            fetchComments(postId);
         } catch (error) {
             console.error('Error editing comment:', error);
         }
@@ -127,6 +161,7 @@ const Reviews = () => {
             });
 
             fetchPosts();
+            fetchComments(postId);
         } catch (error) {
             console.error('Error deleting comment:', error);
         }
@@ -199,7 +234,7 @@ const Reviews = () => {
                                 <div className="flex items-center gap-4 text-xs text-text/60 dark:text-gray-400">
                                     <span className="flex items-center gap-1">
                                         <MessageSquare size={14} />
-                                        {post.comments?.length || 0} comments
+                                        {post.commentCount ?? post.comments?.length ?? 0} comments
                                     </span>
                                     <span>{new Date(post.timestamp).toLocaleDateString()}</span>
                                 </div>
@@ -484,9 +519,9 @@ const Reviews = () => {
                                         <div className="pt-4 border-t border-white/10">
                                             <h3 className="text-xl font-bold text-text dark:text-white mb-6 flex items-center gap-2">
                                                 <MessageSquare size={20} className="text-primary" />
-                                                Comments ({selectedPost.comments?.length || 0})
+                                                Comments ({commentsPostId === selectedPost.id ? comments.length : (selectedPost.commentCount ?? comments.length)})
                                             </h3>
-                                            {selectedPost.comments?.map((comment) => (
+                                            {comments.map((comment) => (
                                                 <div key={comment.id} className="bg-background/50 rounded-lg p-4 mb-3 border border-white/5">
                                                     {editingComment?.id === comment.id ? (
                                                         <div>
@@ -545,7 +580,7 @@ const Reviews = () => {
                                                     )}
                                                 </div>
                                             ))}
-                                            {(!selectedPost.comments || selectedPost.comments.length === 0) && (
+                                            {comments.length === 0 && (
                                                 <p className="text-text/60 dark:text-gray-400 text-sm">No comments yet. Be the first to comment!</p>
                                             )}
                                         </div>
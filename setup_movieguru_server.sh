@@ -10,6 +10,7 @@ APP_NAME="movieguru"
 SERVICE_NAME="web"       # User requested 'web' service name
 BACKEND_PORT=5000        # Standard Flask port
 NGINX_PORT=80            # Standard HTTP port
+SERVER_MODE="asgi"       # "asgi" (async recommend/posts, see backend/asgi.py) or "wsgi" (sync Flask)
 USER_NAME=$(whoami)
 
 # Colors
@@ -47,6 +48,11 @@ cd ..
 # 5. Systemd Service (web)
 echo -e "${GREEN}Configuring Service: $SERVICE_NAME...${NC}"
 BACKEND_DIR=$(pwd)/backend
+if [ "$SERVER_MODE" = "asgi" ]; then
+    GUNICORN_APP="-k uvicorn.workers.UvicornWorker asgi:app"
+else
+    GUNICORN_APP="app:app"
+fi
 
 # Note: This overwrites existing 'web' service
 sudo bash -c "cat > /etc/systemd/system/${SERVICE_NAME}.service <<EOF
@@ -59,7 +65,7 @@ User=$USER_NAME
 Group=www-data
 WorkingDirectory=$BACKEND_DIR
 Environment=\"PATH=$BACKEND_DIR/venv/bin\"
-ExecStart=$BACKEND_DIR/venv/bin/gunicorn --workers 3 --bind 0.0.0.0:${BACKEND_PORT} app:app
+ExecStart=$BACKEND_DIR/venv/bin/gunicorn --workers 3 --bind 0.0.0.0:${BACKEND_PORT} ${GUNICORN_APP}
 
 [Install]
 WantedBy=multi-user.target